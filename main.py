@@ -9,6 +9,7 @@ from shenanigan.dataloaders import create_dataloaders
 from shenanigan.models.stackgan import run_stackgan
 from shenanigan.utils import get_default_settings, save_options
 from shenanigan.utils.datasets import DATASETS
+from shenanigan.utils.distribute import get_strategy
 from shenanigan.models.inception import run_inception
 
 RESULTS_ROOT = "results"
@@ -61,6 +62,13 @@ def parse_arguments(args_to_parse):
     general.add_argument(
         "--evaluate", action="store_true", default=False, help="Run evaluation metrics"
     )
+    general.add_argument(
+        "--num-workers",
+        type=int,
+        required=False,
+        help="Number of processes used to preprocess images when building a dataset. "
+        "Overrides the value in the settings file.",
+    )
 
     stackgan = parser.add_argument_group("StackGAN settings")
     stackgan.add_argument(
@@ -82,8 +90,15 @@ def main(args):
     )
 
     if args.model == "stackgan":
+        # Created first, the devices and cluster are fixed once TensorFlow starts
+        strategy = get_strategy(**default_settings["distribute"])
+        if args.num_workers is not None:
+            default_settings["dataset"]["num_workers"] = args.num_workers
         train_loader, val_loader, small_image_dims, _ = create_dataloaders(
-            args.dataset_name, default_settings["common"]["batch_size"]
+            args.dataset_name,
+            default_settings["common"]["batch_size"],
+            stage=args.stage,
+            **default_settings["dataset"],
         )
         results_dir = os.path.join(RESULTS_ROOT, args.name, f"stage-{args.stage}")
         save_options(options=args, save_dir=results_dir)
@@ -98,6 +113,7 @@ def main(args):
             args.use_pretrained,
             args.visualise,
             args.evaluate,
+            strategy,
         )
     elif args.model == "inception":
         run_inception(args.name, args.dataset_name, default_settings)
@@ -1,41 +1,171 @@
-import os
-from typing import Tuple
+import math
+import tensorflow as tf
+from typing import List, Optional, Tuple
 
-from shenanigan.utils.datasets import get_dataset
-from shenanigan.utils.utils import num_tfrecords_in_dir
+from shenanigan.utils.data_helpers import prepare_batch
+from shenanigan.utils.datasets import AUTOTUNE, STAGE_FEATURES, get_dataset
 
 
 class ImageTextDataLoader(object):
     """ Define a dataloader for image-text pairs """
 
-    def __init__(self, dataset_object: object, batch_size: int, subset: str):
+    def __init__(
+        self,
+        dataset_object: object,
+        batch_size: int,
+        subset: str,
+        features: Optional[List[str]] = None,
+        input_context: Optional[tf.distribute.InputContext] = None,
+    ):
         """ Initialise a ImageTextDataLoader object for either the train
             or test subsets using a BirdsWithWordsDataset object.
+            If features is given, only those features are parsed. If an
+            input_context is given, only this worker's share of the subset is read.
         """
         self.subset = subset
         self.batch_size = batch_size
         self.dataset_object = dataset_object
+        self.input_context = input_context
+        self.features = features
         self.parsed_subset = self.dataset_object.parse_dataset(
-            self.subset, self.batch_size
+            self.subset, self.batch_size, features, input_context
         )
 
     def __call__(self):
         for sample in self.parsed_subset:
             yield sample
 
-    def __len__(self):
-        return num_tfrecords_in_dir(
-            os.path.join(self.dataset_object.directory, self.subset)
+    def prepared(
+        self, num_samples: int, augment: bool, img_size: str, drop_remainder: bool = False
+    ) -> tf.data.Dataset:
+        """ The parsed subset as batches of ready (image, wrong_image, text) tensors.
+            The batches are prepared in the input pipeline, so that the next
+            batch is prepared while the current one is used for training.
+            Arguments:
+                num_samples: int
+                    Number of caption embeddings to average per sample
+                augment: bool
+                    Whether to flip, crop and normalise the images
+                img_size: str
+                    Which images to use, small or large
+                drop_remainder: bool
+                    Drop the last, partial, batch. All batches then have the
+                    same static shape, so a compiled step is traced only once.
+        """
+        return self._prepare(
+            self.parsed_subset,
+            self.batch_size,
+            num_samples,
+            augment,
+            img_size,
+            drop_remainder,
+        )
+
+    def distributed(
+        self,
+        strategy: tf.distribute.Strategy,
+        num_samples: int,
+        augment: bool,
+        img_size: str,
+        drop_remainder: bool = False,
+    ) -> tf.distribute.DistributedDataset:
+        """ The prepared batches split between the replicas of a strategy.
+            batch_size is the global batch size, each replica receives its share of it.
+            Every input pipeline reads its own shards of the subset and repeats
+            them, so that all workers can run the same number of steps,
+            num_batches(drop_remainder), in every epoch. Each epoch is a new
+            pass over the subset.
+            Arguments:
+                strategy: tf.distribute.Strategy
+                    The strategy the batches are used with
+                num_samples, augment, img_size, drop_remainder:
+                    As for prepared
+        """
+
+        def dataset_fn(input_context: tf.distribute.InputContext) -> tf.data.Dataset:
+            per_replica_batch_size = input_context.get_per_replica_batch_size(
+                self.batch_size
+            )
+            parsed_subset = self.dataset_object.parse_dataset(
+                self.subset, per_replica_batch_size, self.features, input_context
+            )
+            # The batches of this pipeline's replicas in num_batches steps. A full
+            # batch left over by dropping the partial ones is not carried into
+            # the next epoch
+            batches_per_epoch = (
+                self.num_batches(drop_remainder)
+                * input_context.num_replicas_in_sync
+                // input_context.num_input_pipelines
+            )
+            return self._prepare(
+                parsed_subset,
+                per_replica_batch_size,
+                num_samples,
+                augment,
+                img_size,
+                drop_remainder,
+            ).take(batches_per_epoch).repeat()
+
+        return strategy.distribute_datasets_from_function(dataset_fn)
+
+    def _prepare(
+        self,
+        parsed_subset: tf.data.Dataset,
+        batch_size: int,
+        num_samples: int,
+        augment: bool,
+        img_size: str,
+        drop_remainder: bool,
+    ) -> tf.data.Dataset:
+        text_embedding_size = self.dataset_object.text_embedding_dim
+        prepared_subset = parsed_subset.map(
+            lambda sample: prepare_batch(
+                sample, text_embedding_size, num_samples, augment, img_size
+            ),
+            num_parallel_calls=AUTOTUNE,
         )
+        if drop_remainder:
+            prepared_subset = prepared_subset.filter(
+                lambda *batch: tf.equal(tf.shape(batch[-1])[0], batch_size)
+            ).map(
+                lambda *batch: tuple(
+                    tf.ensure_shape(x, [batch_size] + x.shape[1:].as_list())
+                    for x in batch
+                )
+            )
+        return prepared_subset.prefetch(AUTOTUNE)
+
+    def num_batches(self, drop_remainder: bool = False) -> int:
+        """ The number of batches in an epoch, without the partial
+            batch if drop_remainder is True
+        """
+        num_examples = self.dataset_object.num_examples(self.subset, self.input_context)
+        if drop_remainder:
+            return num_examples // self.batch_size
+        return math.ceil(num_examples / self.batch_size)
+
+    def num_dropped_examples(self) -> int:
+        """ The number of examples in the partial batch of an epoch, which are
+            not seen in it if drop_remainder is True
+        """
+        num_examples = self.dataset_object.num_examples(self.subset, self.input_context)
+        return num_examples % self.batch_size
+
+    def __len__(self):
+        """ The number of batches in an epoch """
+        return self.num_batches()
 
 
 def create_dataloaders(
-    dataset_name: str, batch_size: int
+    dataset_name: str, batch_size: int, stage: Optional[int] = None, **build_options
 ) -> Tuple[ImageTextDataLoader, ImageTextDataLoader, Tuple[int, int], Tuple[int, int]]:
-    """ Create traing and validation set generators """
-    dataset = get_dataset(dataset_name)
+    """ Create traing and validation set generators. Any build_options are
+        used if the dataset has to be (re)built, e.g. examples_per_shard.
+        If the stage is given, only the features used by that stage are parsed.
+    """
+    dataset = get_dataset(dataset_name, **build_options)
     if dataset.type == "images-with-captions":
-        return image_with_captions_loaders(dataset, batch_size)
+        return image_with_captions_loaders(dataset, batch_size, STAGE_FEATURES.get(stage))
     elif dataset.type == "images-with-tabular":
         return image_with_tabular(dataset, batch_size)
     else:
@@ -51,20 +181,21 @@ def image_with_tabular(
     train_loader = ImageTextDataLoader(
         dataset_object=dataset, batch_size=batch_size, subset="train"
     )
+    # The valid split is stored as the test subset
     test_loader = ImageTextDataLoader(
-        dataset_object=dataset, batch_size=batch_size, subset="valid"
+        dataset_object=dataset, batch_size=batch_size, subset="test"
     )
     return train_loader, test_loader, dataset.get_small_dims(), dataset.get_large_dims()
 
 
 def image_with_captions_loaders(
-    dataset: object, batch_size: int
+    dataset: object, batch_size: int, features: Optional[List[str]] = None
 ) -> Tuple[ImageTextDataLoader, ImageTextDataLoader, Tuple[int, int], Tuple[int, int]]:
     """ Read, prepare, and present the TFRecord data """
     train_loader = ImageTextDataLoader(
-        dataset_object=dataset, batch_size=batch_size, subset="train"
+        dataset_object=dataset, batch_size=batch_size, subset="train", features=features
     )
     test_loader = ImageTextDataLoader(
-        dataset_object=dataset, batch_size=batch_size, subset="test"
+        dataset_object=dataset, batch_size=batch_size, subset="test", features=features
     )
     return train_loader, test_loader, dataset.get_small_dims(), dataset.get_large_dims()
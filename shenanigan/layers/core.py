@@ -39,7 +39,15 @@ class DeconvBlock(layers.Layer):
 
 class ConvBlock(layers.Layer):
     def __init__(
-        self, filters, kernel_size, strides, padding, w_init, bn_init, activation=None
+        self,
+        filters,
+        kernel_size,
+        strides,
+        padding,
+        w_init,
+        bn_init,
+        activation=None,
+        bn_virtual_batch_size=None,
     ):
         super(ConvBlock, self).__init__()
         self.activation = activation
@@ -49,6 +57,7 @@ class ConvBlock(layers.Layer):
         self.padding = padding
         self.w_init = w_init
         self.bn_init = bn_init
+        self.bn_virtual_batch_size = bn_virtual_batch_size
 
     def build(self, input_shape):
         self.conv2d = Conv2D(
@@ -58,7 +67,10 @@ class ConvBlock(layers.Layer):
             padding=self.padding,
             kernel_initializer=self.w_init,
         )
-        self.bn = BatchNormalization(gamma_initializer=self.bn_init)
+        self.bn = BatchNormalization(
+            gamma_initializer=self.bn_init,
+            virtual_batch_size=self.bn_virtual_batch_size,
+        )
 
     def call(self, x, training=True):
         x = self.conv2d(x)
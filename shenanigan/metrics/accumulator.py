@@ -0,0 +1,114 @@
+import tensorflow as tf
+from typing import Dict, Tuple
+
+# Range and number of bins of the discriminator logit histograms
+LOGIT_RANGE = (-10.0, 10.0)
+LOGIT_BINS = 40
+
+
+def discriminator_statistics(
+    real_predictions: tf.Tensor,
+    wrong_predictions: tf.Tensor,
+    fake_predictions: tf.Tensor,
+    value_range: Tuple[float, float] = LOGIT_RANGE,
+    num_bins: int = LOGIT_BINS,
+) -> Dict[str, tf.Tensor]:
+    """ Counts over one batch of discriminator logits, which can be summed over
+        batches and replicas: how many predictions classify real images as real
+        and wrong and fake images as fake, out of how many, and a histogram of
+        the logits of each kind. Logits outside value_range count in the edge bins.
+    """
+    statistics = {
+        "discriminator_correct": tf.add_n(
+            [
+                tf.math.count_nonzero(real_predictions > 0, dtype=tf.float32),
+                tf.math.count_nonzero(wrong_predictions <= 0, dtype=tf.float32),
+                tf.math.count_nonzero(fake_predictions <= 0, dtype=tf.float32),
+            ]
+        ),
+        "discriminator_count": tf.cast(
+            tf.size(real_predictions)
+            + tf.size(wrong_predictions)
+            + tf.size(fake_predictions),
+            tf.float32,
+        ),
+    }
+    for kind, predictions in [
+        ("real", real_predictions),
+        ("wrong", wrong_predictions),
+        ("fake", fake_predictions),
+    ]:
+        statistics[f"{kind}_logits_histogram"] = tf.cast(
+            tf.histogram_fixed_width(
+                tf.cast(predictions, tf.float32), value_range, nbins=num_bins
+            ),
+            tf.float32,
+        )
+    return statistics
+
+
+class MetricsAccumulator(object):
+    """ Running sums of the losses and statistics of an epoch's steps, kept in
+        device variables. Updating them does not copy anything to the host,
+        only result and histograms do.
+    """
+
+    def __init__(self, strategy: tf.distribute.Strategy = None):
+        self.strategy = strategy if strategy is not None else tf.distribute.get_strategy()
+        self._loss_sums = {}
+        self._statistic_sums = {}
+
+    def update(self, losses: Dict[str, tf.Tensor], statistics: Dict[str, tf.Tensor]):
+        """ Add one step's losses, averaged over its batch, and statistics,
+            see discriminator_statistics. Call it in a cross-replica context.
+        """
+        self._variable(self._statistic_sums, "num_steps", []).assign_add(1.0)
+        for name, loss in losses.items():
+            self._variable(self._loss_sums, name, loss.shape).assign_add(
+                tf.cast(loss, tf.float32)
+            )
+        for name, value in statistics.items():
+            self._variable(self._statistic_sums, name, value.shape).assign_add(
+                tf.cast(value, tf.float32)
+            )
+
+    def result(self) -> Dict[str, float]:
+        """ The mean of each loss over the steps so far, and the discriminator's accuracy """
+        if "num_steps" not in self._statistic_sums:
+            return {}
+        num_steps = float(self._statistic_sums["num_steps"].numpy())
+        metrics = {
+            name: float(loss_sum.numpy()) / num_steps
+            for name, loss_sum in self._loss_sums.items()
+        }
+        if "discriminator_count" in self._statistic_sums:
+            metrics["discriminator_accuracy"] = float(
+                self._statistic_sums["discriminator_correct"].numpy()
+            ) / float(self._statistic_sums["discriminator_count"].numpy())
+        return metrics
+
+    def histograms(self) -> Dict[str, float]:
+        """ The histogram counts so far, one {name}_{bin} entry per bin """
+        return {
+            f"{name}_{bin_index}": float(count)
+            for name, counts in self._statistic_sums.items()
+            if name.endswith("_histogram")
+            for bin_index, count in enumerate(counts.numpy())
+        }
+
+    def reset(self):
+        """ Start a new epoch """
+        for variables in [self._loss_sums, self._statistic_sums]:
+            for variable in variables.values():
+                variable.assign(tf.zeros(variable.shape))
+
+    def _variable(self, variables: Dict, name: str, shape: tf.TensorShape) -> tf.Variable:
+        """ The variable variables[name], created as zeros on its first use.
+            It is created eagerly in the strategy's scope, also while a step is traced.
+        """
+        if name not in variables:
+            with tf.init_scope(), self.strategy.scope():
+                variables[name] = tf.Variable(
+                    tf.zeros(shape), trainable=False, name=name
+                )
+        return variables[name]
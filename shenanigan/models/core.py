@@ -3,6 +3,18 @@ from tensorflow.keras import Model
 from typing import Tuple
 
 
+def build_optimizer(lr: float, loss_scaling: bool = False) -> tf.keras.optimizers.Optimizer:
+    """ The Adam optimizer of a GAN network. With loss_scaling (for float16 mixed
+        precision) it is wrapped with dynamic loss scaling, so that small gradients
+        do not underflow. bfloat16 has the exponent range of float32 and
+        needs no loss scaling.
+    """
+    optimizer = tf.keras.optimizers.Adam(lr, beta_1=0.5)
+    if loss_scaling:
+        optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+    return optimizer
+
+
 class ConditionalGAN(Model):
     """ Definition for a generalisable conditional GAN """
 
@@ -26,6 +38,7 @@ class Generator(Model):
         conditional_emb_size: int,
         w_init: tf.Tensor,
         bn_init: tf.Tensor,
+        loss_scaling: bool = False,
     ):
         """ Initialise a Generator instance.
             TODO: Deal with this parameters and make it more logical
@@ -36,10 +49,12 @@ class Generator(Model):
                     Learning rate
                 conditional_emb_size: Tensor
                     text embedding. Shape (batch_size, feature_size, embedding_size)
+                loss_scaling: bool
+                    Scale the loss of the optimizer, see build_optimizer
         """
         super().__init__()
         self.img_size = img_size
-        self.optimizer = tf.keras.optimizers.Adam(lr, beta_1=0.5)
+        self.optimizer = build_optimizer(lr, loss_scaling)
 
         # Weight Initialisation Parameters
         self.w_init = w_init
@@ -57,12 +72,20 @@ class Discriminator(Model):
         lr: float,
         w_init: tf.Tensor,
         bn_init: tf.Tensor,
+        bn_virtual_batch_size: int = None,
+        loss_scaling: bool = False,
     ):
         """ Initialise a Generator instance.
             TODO: Deal with this parameters and make it more logical
                 Arguments:
                 img_size : tuple of ints
                     Size of images. E.g. (1, 32, 32) or (3, 64, 64).
+                bn_virtual_batch_size: int
+                    Normalise each group of this many examples with its own
+                    batch statistics. Used to keep the real, wrong and fake
+                    statistics apart when they are discriminated in one pass.
+                loss_scaling: bool
+                    Scale the loss of the optimizer, see build_optimizer
         """
         super().__init__()
         self.img_size = img_size
@@ -70,5 +93,6 @@ class Discriminator(Model):
         # Weight Initialisation Parameters
         self.w_init = w_init
         self.bn_init = bn_init
+        self.bn_virtual_batch_size = bn_virtual_batch_size
 
-        self.optimizer = tf.keras.optimizers.Adam(lr, beta_1=0.5)
+        self.optimizer = build_optimizer(lr, loss_scaling)
@@ -1,7 +1,6 @@
 import tensorflow as tf
 
 from shenanigan.metrics.inception_score import InceptionScore
-from shenanigan.utils.data_helpers import tensors_from_sample
 
 
 def evaluate(
@@ -15,16 +14,10 @@ def evaluate(
 ):
     incep_score = InceptionScore(experiment_name)
 
-    for _, sample in enumerate(dataloader.parsed_subset):
-        batch_size = len(sample["text"].numpy())
-        _, _, text_tensor = tensors_from_sample(
-            sample,
-            batch_size,
-            dataloader.dataset_object.text_embedding_dim,
-            num_samples,
-            augment,
-            img_size="small",
-        )
+    for _, (_, _, text_tensor) in enumerate(
+        dataloader.prepared(num_samples, augment, img_size="large")
+    ):
+        batch_size = text_tensor.shape[0]
         noise_z = tf.random.normal((batch_size, noise_size))
         fake_images_small, _, _ = stage_1_generator(
             [text_tensor, noise_z], training=False
@@ -11,7 +11,8 @@ class ResidualLayer(layers.Layer):
         w_init: tf.Tensor,
         bn_init: tf.Tensor,
         activation,
-        first_conv_pad: str="valid"
+        first_conv_pad: str="valid",
+        bn_virtual_batch_size: int = None,
     ):
         super(ResidualLayer, self).__init__()
         self.filters_in = filters_in
@@ -20,6 +21,7 @@ class ResidualLayer(layers.Layer):
         self.bn_init = bn_init
         self.activation = activation
         self.first_conv_pad = first_conv_pad
+        self.bn_virtual_batch_size = bn_virtual_batch_size
 
     def build(self, input_shape):
         self.conv2d_1 = Conv2D(
@@ -29,7 +31,10 @@ class ResidualLayer(layers.Layer):
             padding=self.first_conv_pad,
             kernel_initializer=self.w_init,
         )
-        self.bn_1 = BatchNormalization(gamma_initializer=self.bn_init)
+        self.bn_1 = BatchNormalization(
+            gamma_initializer=self.bn_init,
+            virtual_batch_size=self.bn_virtual_batch_size,
+        )
 
         self.conv2d_2 = Conv2D(
             filters=self.filters_in,
@@ -38,7 +43,10 @@ class ResidualLayer(layers.Layer):
             padding="same",
             kernel_initializer=self.w_init,
         )
-        self.bn_2 = BatchNormalization(gamma_initializer=self.bn_init)
+        self.bn_2 = BatchNormalization(
+            gamma_initializer=self.bn_init,
+            virtual_batch_size=self.bn_virtual_batch_size,
+        )
 
         self.conv2d_3 = Conv2D(
             filters=self.filters_out,
@@ -47,7 +55,10 @@ class ResidualLayer(layers.Layer):
             padding="same",
             kernel_initializer=self.w_init,
         )
-        self.bn_3 = BatchNormalization(gamma_initializer=self.bn_init)
+        self.bn_3 = BatchNormalization(
+            gamma_initializer=self.bn_init,
+            virtual_batch_size=self.bn_virtual_batch_size,
+        )
 
     def call(self, x: tf.Tensor, training: bool = True):
         x = self.conv2d_1(x)
@@ -79,7 +90,7 @@ class ConditionalAugmentation(layers.Layer):
     def call(self, embedding: tf.Tensor):
         mean = tf.nn.leaky_relu(self.dense_mean(embedding), alpha=0.2)
         log_sigma = tf.nn.leaky_relu(self.dense_sigma(embedding), alpha=0.2)
-        epsilon = tf.random.truncated_normal(tf.shape(mean))
+        epsilon = tf.random.truncated_normal(tf.shape(mean), dtype=mean.dtype)
         stddev = tf.math.exp(log_sigma)
         smoothed_embedding = mean + stddev * epsilon
         return smoothed_embedding, mean, log_sigma
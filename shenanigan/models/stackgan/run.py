@@ -46,6 +46,33 @@ def load_model(
     return model
 
 
+def discriminator_bn_virtual_batch_size(
+    settings, stage: int, strategy: tf.distribute.Strategy
+) -> int:
+    """ A fused discriminator pass normalises each replica's real, wrong and fake
+        micro-batches separately, as separate passes do, unless joint statistics
+        are asked for. None if the discriminator uses plain batch normalisation.
+    """
+    if (
+        not settings["common"]["fused_discriminator"]
+        or settings["common"]["fused_bn_statistics"] != "per_call"
+    ):
+        return None
+    return settings["common"]["batch_size"] // (
+        strategy.num_replicas_in_sync * settings[f"stage{stage}"]["accumulation_steps"]
+    )
+
+
+def set_precision(precision: str) -> bool:
+    """ Set the mixed precision policy (float32, mixed_float16 or mixed_bfloat16)
+        the networks are built with, and return whether their optimizers have
+        to scale the loss. The default float32 policy is left untouched.
+    """
+    if precision != "float32":
+        tf.keras.mixed_precision.set_global_policy(precision)
+    return precision == "mixed_float16"
+
+
 def run(
     train_loader: object,
     val_loader: object,
@@ -57,7 +84,9 @@ def run(
     use_pretrained: bool = False,
     visualise: bool = False,
     evaluate: bool = False,
+    strategy: tf.distribute.Strategy = None,
 ):
+    strategy = strategy if strategy is not None else tf.distribute.get_strategy()
     lr_decay = LearningRateDecay(
         decay_factor=settings["callbacks"]["learning_rate_decay"]["decay_factor"],
         every_n=settings["callbacks"]["learning_rate_decay"]["every_n"],
@@ -172,14 +201,22 @@ def run(
         )
 
     elif stage == 1:
-        model = StackGAN1(
-            img_size=small_image_dims,
-            lr_g=settings["stage1"]["generator"]["learning_rate"],
-            lr_d=settings["stage1"]["discriminator"]["learning_rate"],
-            conditional_emb_size=settings["stage1"]["conditional_emb_size"],
-            w_init=tf.random_normal_initializer(stddev=0.02),
-            bn_init=tf.random_normal_initializer(1.0, 0.02),
-        )
+        # Set before the networks are built
+        loss_scaling = set_precision(settings["stage1"]["precision"])
+        # Variables and optimizer slots have to be created in the strategy's scope
+        with strategy.scope():
+            model = StackGAN1(
+                img_size=small_image_dims,
+                lr_g=settings["stage1"]["generator"]["learning_rate"],
+                lr_d=settings["stage1"]["discriminator"]["learning_rate"],
+                conditional_emb_size=settings["stage1"]["conditional_emb_size"],
+                w_init=tf.random_normal_initializer(stddev=0.02),
+                bn_init=tf.random_normal_initializer(1.0, 0.02),
+                discriminator_bn_virtual_batch_size=discriminator_bn_virtual_batch_size(
+                    settings, stage, strategy
+                ),
+                loss_scaling=loss_scaling,
+            )
 
         trainer_class = get_trainer(stage)
         trainer = trainer_class(
@@ -193,35 +230,51 @@ def run(
             num_samples=settings["stage1"]["num_samples"],
             noise_size=settings["stage1"]["noise_size"],
             augment=settings["stage1"]["augment"],
+            strategy=strategy,
+            compile_steps=settings["common"]["compile"],
+            jit_compile=settings["common"]["jit_compile"],
+            fused_discriminator=settings["common"]["fused_discriminator"],
+            progress_every=settings["common"]["progress_every"],
+            accumulation_steps=settings["stage1"]["accumulation_steps"],
+            async_checkpoints=settings["common"]["async_checkpoints"],
         )
         trainer(train_loader, val_loader, num_epochs=settings["stage1"]["num_epochs"])
         plotter = LogPlotter(results_dir)
         plotter.learning_curve()
 
     elif stage == 2:
-        model_stage1 = StackGAN1(
-            img_size=small_image_dims,
-            lr_g=settings["stage1"]["generator"]["learning_rate"],
-            lr_d=settings["stage1"]["discriminator"]["learning_rate"],
-            conditional_emb_size=settings["stage1"]["conditional_emb_size"],
-            w_init=tf.random_normal_initializer(stddev=0.02),
-            bn_init=tf.random_normal_initializer(1.0, 0.02),
-        )
-        checkpointer = Checkpointer(
-            model=model_stage1,
-            save_dir=checkpoint_dir.replace("stage-2", "stage-1"),
-            max_keep=None,
-        )
-        checkpointer.restore(use_pretrained=True, evaluate=True)
+        # The stage 1 generator runs with the stage 2 policy too, its layers
+        # are built on its first call
+        loss_scaling = set_precision(settings["stage2"]["precision"])
+        # Variables and optimizer slots have to be created in the strategy's scope
+        with strategy.scope():
+            model_stage1 = StackGAN1(
+                img_size=small_image_dims,
+                lr_g=settings["stage1"]["generator"]["learning_rate"],
+                lr_d=settings["stage1"]["discriminator"]["learning_rate"],
+                conditional_emb_size=settings["stage1"]["conditional_emb_size"],
+                w_init=tf.random_normal_initializer(stddev=0.02),
+                bn_init=tf.random_normal_initializer(1.0, 0.02),
+            )
+            checkpointer = Checkpointer(
+                model=model_stage1,
+                save_dir=checkpoint_dir.replace("stage-2", "stage-1"),
+                max_keep=None,
+            )
+            checkpointer.restore(use_pretrained=True, evaluate=True)
 
-        model_stage2 = StackGAN2(
-            img_size=small_image_dims,
-            lr_g=settings["stage2"]["generator"]["learning_rate"],
-            lr_d=settings["stage2"]["discriminator"]["learning_rate"],
-            conditional_emb_size=settings["stage2"]["conditional_emb_size"],
-            w_init=tf.random_normal_initializer(stddev=0.02),
-            bn_init=tf.random_normal_initializer(1.0, 0.02),
-        )
+            model_stage2 = StackGAN2(
+                img_size=small_image_dims,
+                lr_g=settings["stage2"]["generator"]["learning_rate"],
+                lr_d=settings["stage2"]["discriminator"]["learning_rate"],
+                conditional_emb_size=settings["stage2"]["conditional_emb_size"],
+                w_init=tf.random_normal_initializer(stddev=0.02),
+                bn_init=tf.random_normal_initializer(1.0, 0.02),
+                discriminator_bn_virtual_batch_size=discriminator_bn_virtual_batch_size(
+                    settings, stage, strategy
+                ),
+                loss_scaling=loss_scaling,
+            )
 
         trainer_class = get_trainer(stage)
         trainer = trainer_class(
@@ -236,6 +289,13 @@ def run(
             noise_size=settings["stage1"]["noise_size"],
             augment=settings["stage2"]["augment"],
             stage_1_generator=model_stage1.generator,
+            strategy=strategy,
+            compile_steps=settings["common"]["compile"],
+            jit_compile=settings["common"]["jit_compile"],
+            fused_discriminator=settings["common"]["fused_discriminator"],
+            progress_every=settings["common"]["progress_every"],
+            accumulation_steps=settings["stage2"]["accumulation_steps"],
+            async_checkpoints=settings["common"]["async_checkpoints"],
         )
 
         trainer(train_loader, val_loader, num_epochs=settings[f"stage2"]["num_epochs"])
@@ -26,6 +26,8 @@ class StackGAN1(ConditionalGAN):
         conditional_emb_size: int,
         w_init: tf.Tensor,
         bn_init: tf.Tensor,
+        discriminator_bn_virtual_batch_size: int = None,
+        loss_scaling: bool = False,
     ):
 
         generator = GeneratorStage1(
@@ -34,6 +36,7 @@ class StackGAN1(ConditionalGAN):
             conditional_emb_size=conditional_emb_size,
             w_init=w_init,
             bn_init=bn_init,
+            loss_scaling=loss_scaling,
         )
 
         discriminator = DiscriminatorStage1(
@@ -42,6 +45,8 @@ class StackGAN1(ConditionalGAN):
             conditional_emb_size=conditional_emb_size,
             w_init=w_init,
             bn_init=bn_init,
+            bn_virtual_batch_size=discriminator_bn_virtual_batch_size,
+            loss_scaling=loss_scaling,
         )
 
         super().__init__(
@@ -61,6 +66,7 @@ class GeneratorStage1(Generator):
         conditional_emb_size: int,
         w_init: tf.Tensor,
         bn_init: tf.Tensor,
+        loss_scaling: bool = False,
     ):
         """ Initialise a Generator instance.
             TODO: Deal with this parameters and make it more logical
@@ -71,7 +77,9 @@ class GeneratorStage1(Generator):
                     [91, 125, 128]
                 lr : float
         """
-        super().__init__(img_size, lr, conditional_emb_size, w_init, bn_init)
+        super().__init__(
+            img_size, lr, conditional_emb_size, w_init, bn_init, loss_scaling
+        )
         self.num_output_channels = self.img_size[0]
         self.conditional_emb_size = conditional_emb_size
         self.kl_coeff = 2
@@ -79,7 +87,9 @@ class GeneratorStage1(Generator):
             self.num_output_channels == 3 or self.num_output_channels == 1
         ), f"The number of output channels must be 2 or 1. Found {self.num_output_channels}"
 
-        self.loss = tf.keras.losses.BinaryCrossentropy(from_logits=True)
+        self.loss = tf.keras.losses.BinaryCrossentropy(
+            from_logits=True, reduction=tf.keras.losses.Reduction.NONE
+        )
 
     def build(self, input_shape):
         self.conditional_augmentation = ConditionalAugmentation(
@@ -129,11 +139,13 @@ class GeneratorStage1(Generator):
             kernel_initializer=self.w_init,
         )
 
-        self.tanh = Activation("tanh")
+        # Outputs stay float32 under mixed precision
+        self.tanh = Activation("tanh", dtype="float32")
 
     def call(self, inputs: tf.Tensor, training: bool = True):
         embedding, noise = inputs
         smoothed_embedding, mean, log_sigma = self.conditional_augmentation(embedding)
+        noise = tf.cast(noise, smoothed_embedding.dtype)
         noisy_embedding = tf.concat([noise, smoothed_embedding], 1)
 
         x = self.dense_1(noisy_embedding)
@@ -175,6 +187,8 @@ class DiscriminatorStage1(Discriminator):
         conditional_emb_size: int,
         w_init: tf.Tensor,
         bn_init: tf.Tensor,
+        bn_virtual_batch_size: int = None,
+        loss_scaling: bool = False,
     ):
         """ Initialise a Generator instance.
             TODO: Deal with this parameters and make it more logical
@@ -183,11 +197,15 @@ class DiscriminatorStage1(Discriminator):
                     Size of images. E.g. (1, 32, 32) or (3, 64, 64).
                 lr : float
         """
-        super().__init__(img_size, lr, w_init, bn_init)
+        super().__init__(
+            img_size, lr, w_init, bn_init, bn_virtual_batch_size, loss_scaling
+        )
         self.d_dim = 64
         self.conditional_emb_size = conditional_emb_size
 
-        self.loss = tf.keras.losses.BinaryCrossentropy(from_logits=True)
+        self.loss = tf.keras.losses.BinaryCrossentropy(
+            from_logits=True, reduction=tf.keras.losses.Reduction.NONE
+        )
 
     def build(self, input_size):
         activation = lambda l: tf.nn.leaky_relu(l, alpha=0.2)  # noqa
@@ -207,6 +225,7 @@ class DiscriminatorStage1(Discriminator):
             padding="same",
             w_init=self.w_init,
             bn_init=self.bn_init,
+            bn_virtual_batch_size=self.bn_virtual_batch_size,
             activation=activation,
         )
         self.conv_block_2 = ConvBlock(
@@ -216,6 +235,7 @@ class DiscriminatorStage1(Discriminator):
             padding="same",
             w_init=self.w_init,
             bn_init=self.bn_init,
+            bn_virtual_batch_size=self.bn_virtual_batch_size,
             activation=activation,
         )
         self.conv_block_3 = ConvBlock(
@@ -225,6 +245,7 @@ class DiscriminatorStage1(Discriminator):
             padding="same",
             w_init=self.w_init,
             bn_init=self.bn_init,
+            bn_virtual_batch_size=self.bn_virtual_batch_size,
         )
 
         self.res_block = ResidualLayer(
@@ -232,6 +253,7 @@ class DiscriminatorStage1(Discriminator):
             filters_out=self.d_dim * 8,
             w_init=self.w_init,
             bn_init=self.bn_init,
+            bn_virtual_batch_size=self.bn_virtual_batch_size,
             activation=activation,
         )
 
@@ -244,6 +266,7 @@ class DiscriminatorStage1(Discriminator):
             padding="valid",
             w_init=self.w_init,
             bn_init=self.bn_init,
+            bn_virtual_batch_size=self.bn_virtual_batch_size,
             activation=activation,
         )
 
@@ -254,6 +277,8 @@ class DiscriminatorStage1(Discriminator):
             strides=(4, 4),
             padding="valid",
             kernel_initializer=self.w_init,
+            # The logits stay float32 under mixed precision
+            dtype="float32",
         )
 
     def call(self, inputs: tf.Tensor, training: bool = True):
@@ -272,7 +297,9 @@ class DiscriminatorStage1(Discriminator):
         reduced_embedding = self.dense_embed(embedding)
         reduced_embedding = tf.nn.leaky_relu(reduced_embedding, alpha=0.2)
         reduced_embedding = tf.expand_dims(tf.expand_dims(reduced_embedding, 1), 1)
-        reduced_embedding = tf.tile(reduced_embedding, [1, 4, 4, 1])
+        # The images can be several batches for the same text, see Trainer.discriminate
+        num_image_batches = tf.shape(x)[0] // tf.shape(reduced_embedding)[0]
+        reduced_embedding = tf.tile(reduced_embedding, [num_image_batches, 4, 4, 1])
         x = tf.concat([x, reduced_embedding], 3)
 
         x = self.conv_block_4(x, training=training)
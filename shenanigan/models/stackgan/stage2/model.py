@@ -12,7 +12,17 @@ from shenanigan.utils.utils import kl_loss
 class StackGAN2(ConditionalGAN):
     """ Definition for the stage 2 StackGAN """
 
-    def __init__(self, img_size, lr_g, lr_d, conditional_emb_size, w_init, bn_init):
+    def __init__(
+        self,
+        img_size,
+        lr_g,
+        lr_d,
+        conditional_emb_size,
+        w_init,
+        bn_init,
+        discriminator_bn_virtual_batch_size=None,
+        loss_scaling=False,
+    ):
 
         generator = GeneratorStage2(
             img_size=img_size,
@@ -20,6 +30,7 @@ class StackGAN2(ConditionalGAN):
             conditional_emb_size=conditional_emb_size,
             w_init=w_init,
             bn_init=bn_init,
+            loss_scaling=loss_scaling,
         )
 
         discriminator = DiscriminatorStage2(
@@ -28,6 +39,8 @@ class StackGAN2(ConditionalGAN):
             conditional_emb_size=conditional_emb_size,
             w_init=w_init,
             bn_init=bn_init,
+            bn_virtual_batch_size=discriminator_bn_virtual_batch_size,
+            loss_scaling=loss_scaling,
         )
 
         super().__init__(
@@ -47,6 +60,7 @@ class GeneratorStage2(Generator):
         conditional_emb_size: int,
         w_init: tf.Tensor,
         bn_init: tf.Tensor,
+        loss_scaling: bool = False,
     ):
         """ Initialise a Generator instance.
             TODO: Deal with this parameters and make it more logical
@@ -57,11 +71,15 @@ class GeneratorStage2(Generator):
                     [91, 125, 128]
                 lr : float
         """
-        super().__init__(img_size, lr, conditional_emb_size, w_init, bn_init)
+        super().__init__(
+            img_size, lr, conditional_emb_size, w_init, bn_init, loss_scaling
+        )
         self.num_output_channels = self.img_size[0]
         self.conditional_emb_size = conditional_emb_size
         self.kl_coeff = 2
-        self.loss = tf.keras.losses.BinaryCrossentropy(from_logits=True)
+        self.loss = tf.keras.losses.BinaryCrossentropy(
+            from_logits=True, reduction=tf.keras.losses.Reduction.NONE
+        )
 
         assert (
             self.num_output_channels == 3 or self.num_output_channels == 1
@@ -144,7 +162,8 @@ class GeneratorStage2(Generator):
             padding="same",
             kernel_initializer=he_init
         )
-        self.tanh = Activation("tanh")
+        # Outputs stay float32 under mixed precision
+        self.tanh = Activation("tanh", dtype="float32")
 
     def call(self, inputs: tf.Tensor, training: bool = True):
         generated_image, embedding = inputs
@@ -193,6 +212,8 @@ class DiscriminatorStage2(Discriminator):
         conditional_emb_size: int,
         w_init: tf.Tensor,
         bn_init: tf.Tensor,
+        bn_virtual_batch_size: int = None,
+        loss_scaling: bool = False,
     ):
         """ Initialise a Generator instance.
             TODO: Deal with this parameters and make it more logical
@@ -201,10 +222,14 @@ class DiscriminatorStage2(Discriminator):
                     Size of images. E.g. (1, 32, 32) or (3, 64, 64).
                 lr : float
         """
-        super().__init__(img_size, lr, w_init, bn_init)
+        super().__init__(
+            img_size, lr, w_init, bn_init, bn_virtual_batch_size, loss_scaling
+        )
         self.d_dim = 64
         self.conditional_emb_size = conditional_emb_size
-        self.loss = tf.keras.losses.BinaryCrossentropy(from_logits=True)
+        self.loss = tf.keras.losses.BinaryCrossentropy(
+            from_logits=True, reduction=tf.keras.losses.Reduction.NONE
+        )
 
     def build(self, input_size):
         activation = lambda l: tf.nn.leaky_relu(l, alpha=0.2)  # noqa
@@ -224,6 +249,7 @@ class DiscriminatorStage2(Discriminator):
             padding="same",
             w_init=self.w_init,
             bn_init=self.bn_init,
+            bn_virtual_batch_size=self.bn_virtual_batch_size,
             activation=activation,
         )
 
@@ -234,6 +260,7 @@ class DiscriminatorStage2(Discriminator):
             padding="same",
             w_init=self.w_init,
             bn_init=self.bn_init,
+            bn_virtual_batch_size=self.bn_virtual_batch_size,
             activation=activation,
         )
 
@@ -244,6 +271,7 @@ class DiscriminatorStage2(Discriminator):
             padding="same",
             w_init=self.w_init,
             bn_init=self.bn_init,
+            bn_virtual_batch_size=self.bn_virtual_batch_size,
             activation=activation,
         )
 
@@ -254,6 +282,7 @@ class DiscriminatorStage2(Discriminator):
             padding="same",
             w_init=self.w_init,
             bn_init=self.bn_init,
+            bn_virtual_batch_size=self.bn_virtual_batch_size,
             activation=activation,
         )
 
@@ -264,6 +293,7 @@ class DiscriminatorStage2(Discriminator):
             padding="same",
             w_init=self.w_init,
             bn_init=self.bn_init,
+            bn_virtual_batch_size=self.bn_virtual_batch_size,
             activation=activation,
         )
 
@@ -274,6 +304,7 @@ class DiscriminatorStage2(Discriminator):
             padding="same",
             w_init=self.w_init,
             bn_init=self.bn_init,
+            bn_virtual_batch_size=self.bn_virtual_batch_size,
             activation=activation,
         )
 
@@ -284,10 +315,17 @@ class DiscriminatorStage2(Discriminator):
             padding="same",
             w_init=self.w_init,
             bn_init=self.bn_init,
+            bn_virtual_batch_size=self.bn_virtual_batch_size,
         )
 
         self.res_block = ResidualLayer(
-            self.d_dim * 2, self.d_dim * 8, self.w_init, self.bn_init, activation, first_conv_pad="same"
+            self.d_dim * 2,
+            self.d_dim * 8,
+            self.w_init,
+            self.bn_init,
+            activation,
+            first_conv_pad="same",
+            bn_virtual_batch_size=self.bn_virtual_batch_size,
         )
 
         self.dense_embed = Dense(units=self.conditional_emb_size)
@@ -299,6 +337,7 @@ class DiscriminatorStage2(Discriminator):
             padding="same",
             w_init=self.w_init,
             bn_init=self.bn_init,
+            bn_virtual_batch_size=self.bn_virtual_batch_size,
             activation=activation,
         )
 
@@ -309,6 +348,8 @@ class DiscriminatorStage2(Discriminator):
             strides=(4, 4),
             padding="same",
             kernel_initializer=self.w_init,
+            # The logits stay float32 under mixed precision
+            dtype="float32",
         )
 
     def call(self, inputs: tf.Tensor, training: bool = True):
@@ -331,7 +372,9 @@ class DiscriminatorStage2(Discriminator):
         reduced_embedding = self.dense_embed(embedding)
         reduced_embedding = tf.nn.leaky_relu(reduced_embedding, alpha=0.2)
         reduced_embedding = tf.expand_dims(tf.expand_dims(reduced_embedding, 1), 1)
-        reduced_embedding = tf.tile(reduced_embedding, [1, 4, 4, 1])
+        # The images can be several batches for the same text, see Trainer.discriminate
+        num_image_batches = tf.shape(x)[0] // tf.shape(reduced_embedding)[0]
+        reduced_embedding = tf.tile(reduced_embedding, [num_image_batches, 4, 4, 1])
         x = tf.concat([x, reduced_embedding], 3)
 
         x = self.conv_block_9(x, training=training)
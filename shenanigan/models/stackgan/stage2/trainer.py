@@ -1,9 +1,6 @@
-import numpy as np
 import tensorflow as tf
-from tqdm import trange
 
 from shenanigan.trainers import Trainer
-from shenanigan.utils.data_helpers import tensors_from_sample
 
 
 class Stage2Trainer(Trainer):
@@ -19,6 +16,13 @@ class Stage2Trainer(Trainer):
         callbacks=None,
         use_pretrained: bool = False,
         show_progress_bar: bool = True,
+        strategy: tf.distribute.Strategy = None,
+        compile_steps: bool = False,
+        jit_compile: bool = False,
+        fused_discriminator: bool = False,
+        progress_every: int = 10,
+        accumulation_steps: int = 1,
+        async_checkpoints: bool = False,
         **kwargs
     ):
         """ Initialise a model trainer for iamge data.
@@ -40,6 +44,13 @@ class Stage2Trainer(Trainer):
             callbacks,
             use_pretrained,
             show_progress_bar,
+            strategy,
+            compile_steps,
+            jit_compile,
+            fused_discriminator,
+            progress_every,
+            accumulation_steps,
+            async_checkpoints,
         )
         self.num_samples = kwargs.get("num_samples")
         self.noise_size = kwargs.get("noise_size")
@@ -48,248 +59,172 @@ class Stage2Trainer(Trainer):
 
     def train_epoch(self, train_loader: object, epoch_num: int):
         """ Training operations for a single epoch """
-        acc_generator_loss = 0
-        acc_discriminator_loss = 0
-        acc_kl_loss = 0
-        acc_disc_real_loss = 0
-        acc_disc_wrong_loss = 0
-        acc_disc_fake_loss = 0
-        text_embedding_size = train_loader.dataset_object.text_embedding_dim
-        kwargs = dict(
-            desc="Epoch {}".format(epoch_num),
-            leave=False,
-            disable=not self.show_progress_bar,
+        return self.run_epoch(
+            train_loader,
+            epoch_num,
+            self.train_step,
+            self.num_samples,
+            self.augment,
+            img_size="large",
         )
-        with trange(len(train_loader), **kwargs) as t:
-            for batch_idx, sample in enumerate(train_loader.parsed_subset):
-                batch_size = len(sample["text"].numpy())
-                image_large, wrong_image_large, text_tensor = tensors_from_sample(
-                    sample,
-                    batch_size,
-                    text_embedding_size,
-                    self.num_samples,
-                    self.augment,
-                    img_size="large",
-                )
 
-                with tf.GradientTape() as generator_tape, tf.GradientTape() as discriminator_tape:
-                    # Forward pass the stage 1 generator to obtain small fake images
-                    noise_z = tf.random.normal((batch_size, self.noise_size))
-                    fake_images_small, _, _ = self.stage_1_generator(
-                        [text_tensor, noise_z], training=False
-                    )
-
-                    fake_images_large = self.model.generator(
-                        [fake_images_small, text_tensor], training=True
-                    )
-                    assert (
-                        fake_images_large.shape == image_large.shape
-                    ), "Real ({}) and fakes ({}) images must have the same dimensions".format(
-                        image_large.shape, fake_images_large.shape
-                    )
-
-                    real_predictions = self.model.discriminator(
-                        [image_large, text_tensor], training=True
-                    )
-                    wrong_predictions = self.model.discriminator(
-                        [wrong_image_large, text_tensor], training=True
-                    )
-                    fake_predictions = self.model.discriminator(
-                        [fake_images_large, text_tensor], training=True
-                    )
+    def val_epoch(self, val_loader: object, epoch_num: int):
+        return self.run_epoch(
+            val_loader,
+            epoch_num,
+            self.val_step,
+            self.num_samples,
+            self.augment,
+            img_size="large",
+        )
 
-                    assert (
-                        real_predictions.shape
-                        == wrong_predictions.shape
-                        == fake_predictions.shape
-                    ), "Real ({}), wrong ({}) and fake ({}) image predictions must have the same dimensions".format(
-                        real_predictions.shape,
-                        wrong_predictions.shape,
-                        fake_predictions.shape,
-                    )
+    def train_losses(
+        self, image_large: tf.Tensor, wrong_image_large: tf.Tensor, text_tensor: tf.Tensor
+    ):
+        """ The training losses of one replica's (micro-)batch, averaged over the
+            (micro-)batches of all replicas, and the discriminator's real, wrong and
+            fake predictions. Trainer.train_step runs it under the gradient tapes.
+        """
+        batch_size = tf.shape(image_large)[0]
 
-                    generator_loss = self.model.generator.loss(
-                        tf.ones_like(fake_predictions), fake_predictions
-                    )
-                    kl_loss = sum(self.model.generator.losses)
-                    generator_loss += kl_loss
+        # Forward pass the stage 1 generator to obtain small fake images
+        noise_z = tf.random.normal((batch_size, self.noise_size))
+        fake_images_small, _, _ = self.stage_1_generator(
+            [text_tensor, noise_z], training=False
+        )
 
-                    disc_real_loss = self.model.discriminator.loss(
-                        tf.fill(real_predictions.shape, 0.9), real_predictions
-                    )
-                    disc_wrong_loss = self.model.discriminator.loss(
-                        tf.zeros_like(wrong_predictions), wrong_predictions
-                    )
-                    disc_fake_loss = self.model.discriminator.loss(
-                        tf.zeros_like(fake_predictions), fake_predictions
-                    )
+        fake_images_large = self.model.generator(
+            [fake_images_small, text_tensor], training=True
+        )
+        assert (
+            fake_images_large.shape == image_large.shape
+        ), "Real ({}) and fakes ({}) images must have the same dimensions".format(
+            image_large.shape, fake_images_large.shape
+        )
 
-                    discriminator_loss = (
-                        disc_real_loss + 0.5 * disc_wrong_loss + 0.5 * disc_fake_loss
-                    )
+        real_predictions, wrong_predictions, fake_predictions = self.discriminate(
+            [image_large, wrong_image_large, fake_images_large],
+            text_tensor,
+            training=True,
+        )
 
-                # Update gradients
-                generator_gradients = generator_tape.gradient(
-                    generator_loss, self.model.generator.trainable_variables
-                )
-                discriminator_gradients = discriminator_tape.gradient(
-                    discriminator_loss, self.model.discriminator.trainable_variables
-                )
+        assert (
+            real_predictions.shape
+            == wrong_predictions.shape
+            == fake_predictions.shape
+        ), "Real ({}), wrong ({}) and fake ({}) image predictions must have the same dimensions".format(
+            real_predictions.shape,
+            wrong_predictions.shape,
+            fake_predictions.shape,
+        )
 
-                self.model.generator.optimizer.apply_gradients(
-                    zip(generator_gradients, self.model.generator.trainable_variables)
-                )
-                self.model.discriminator.optimizer.apply_gradients(
-                    zip(
-                        discriminator_gradients,
-                        self.model.discriminator.trainable_variables,
-                    )
-                )
-                # Update tqdm
-                t.set_postfix(
-                    kl_loss=float(kl_loss),
-                    generator_loss=float(generator_loss),
-                    discriminator_loss=float(discriminator_loss),
-                    disc_real_loss=float(disc_real_loss),
-                    disc_wrong_loss=float(disc_wrong_loss),
-                    disc_fake_loss=float(disc_fake_loss),
-                )
-                t.update()
+        generator_loss = tf.nn.compute_average_loss(
+            self.model.generator.loss(
+                tf.ones_like(fake_predictions), fake_predictions
+            )
+        )
+        kl_loss = tf.nn.scale_regularization_loss(sum(self.model.generator.losses))
+        generator_loss += kl_loss
 
-                # Accumulate losses over all samples
-                acc_generator_loss += generator_loss
-                acc_discriminator_loss += discriminator_loss
-                acc_kl_loss += kl_loss
-                acc_disc_real_loss += disc_real_loss
-                acc_disc_wrong_loss += disc_wrong_loss
-                acc_disc_fake_loss += disc_fake_loss
+        disc_real_loss = tf.nn.compute_average_loss(
+            self.model.discriminator.loss(
+                tf.fill(tf.shape(real_predictions), 0.9), real_predictions
+            )
+        )
+        disc_wrong_loss = tf.nn.compute_average_loss(
+            self.model.discriminator.loss(
+                tf.zeros_like(wrong_predictions), wrong_predictions
+            )
+        )
+        disc_fake_loss = tf.nn.compute_average_loss(
+            self.model.discriminator.loss(
+                tf.zeros_like(fake_predictions), fake_predictions
+            )
+        )
 
-                # if batch_idx == 1:
-                #     break
+        discriminator_loss = (
+            disc_real_loss + 0.5 * disc_wrong_loss + 0.5 * disc_fake_loss
+        )
 
-        return {
-            "generator_loss": np.asscalar(acc_generator_loss.numpy()) / (batch_idx + 1),
-            "discriminator_loss": np.asscalar(acc_discriminator_loss.numpy())
-            / (batch_idx + 1),
-            "kl_loss": np.asscalar(acc_kl_loss.numpy()) / (batch_idx + 1),
-            "discriminator_real_loss": np.asscalar(acc_disc_real_loss.numpy())
-            / (batch_idx + 1),
-            "discriminator_wrong_loss": np.asscalar(acc_disc_wrong_loss.numpy())
-            / (batch_idx + 1),
-            "discriminator_fake_loss": np.asscalar(acc_disc_fake_loss.numpy())
-            / (batch_idx + 1),
+        losses = {
+            "generator_loss": generator_loss,
+            "discriminator_loss": discriminator_loss,
+            "kl_loss": kl_loss,
+            "discriminator_real_loss": disc_real_loss,
+            "discriminator_wrong_loss": disc_wrong_loss,
+            "discriminator_fake_loss": disc_fake_loss,
         }
+        return losses, (real_predictions, wrong_predictions, fake_predictions)
 
-    def val_epoch(self, val_loader: object, epoch_num: int):
-        acc_generator_loss = 0
-        acc_discriminator_loss = 0
-        acc_kl_loss = 0
-        acc_disc_real_loss = 0
-        acc_disc_wrong_loss = 0
-        acc_disc_fake_loss = 0
-        text_embedding_size = val_loader.dataset_object.text_embedding_dim
-        kwargs = dict(
-            desc="Epoch {}".format(epoch_num),
-            leave=False,
-            disable=not self.show_progress_bar,
+    def val_losses(
+        self, image_large: tf.Tensor, wrong_image_large: tf.Tensor, text_tensor: tf.Tensor
+    ):
+        """ The validation losses of one replica's (micro-)batch, averaged over the
+            (micro-)batches of all replicas, and the discriminator's real, wrong and
+            fake predictions
+        """
+        batch_size = tf.shape(image_large)[0]
+        # Generate fake small images
+        noise_z = tf.random.normal((batch_size, self.noise_size))
+        fake_images_small, _, _ = self.stage_1_generator(
+            [text_tensor, noise_z], training=False
         )
-        with trange(len(val_loader), **kwargs) as t:
-            for batch_idx, sample in enumerate(val_loader.parsed_subset):
-                batch_size = len(sample["text"].numpy())
-                image_large, wrong_image_large, text_tensor = tensors_from_sample(
-                    sample,
-                    batch_size,
-                    text_embedding_size,
-                    self.num_samples,
-                    self.augment,
-                    img_size="large",
-                )
-                # Generate fake small images
-                noise_z = tf.random.normal((batch_size, self.noise_size))
-                fake_images_small, _, _ = self.stage_1_generator(
-                    [text_tensor, noise_z], training=False
-                )
-
-                fake_images = self.model.generator(
-                    [fake_images_small, text_tensor], training=False
-                )
-                assert (
-                    fake_images.shape == image_large.shape
-                ), "Real ({}) and fakes ({}) images must have the same dimensions".format(
-                    image_large.shape, fake_images.shape
-                )
 
-                real_predictions = self.model.discriminator(
-                    [image_large, text_tensor], training=False
-                )
-                wrong_predictions = self.model.discriminator(
-                    [wrong_image_large, text_tensor], training=False
-                )
-                fake_predictions = self.model.discriminator(
-                    [fake_images, text_tensor], training=False
-                )
-
-                assert (
-                    real_predictions.shape
-                    == wrong_predictions.shape
-                    == fake_predictions.shape
-                ), "Real ({}), wrong ({}) and fake ({}) image predictions must have the same dimensions".format(
-                    real_predictions.shape,
-                    wrong_predictions.shape,
-                    fake_predictions.shape,
-                )
-
-                generator_loss = self.model.generator.loss(
-                    tf.ones_like(fake_predictions), fake_predictions
-                )
-                kl_loss = sum(self.model.generator.losses)
-                generator_loss += kl_loss
+        fake_images = self.model.generator(
+            [fake_images_small, text_tensor], training=False
+        )
+        assert (
+            fake_images.shape == image_large.shape
+        ), "Real ({}) and fakes ({}) images must have the same dimensions".format(
+            image_large.shape, fake_images.shape
+        )
 
-                disc_real_loss = self.model.discriminator.loss(
-                    tf.ones_like(real_predictions), real_predictions
-                )
-                disc_wrong_loss = self.model.discriminator.loss(
-                    tf.zeros_like(wrong_predictions), wrong_predictions
-                )
-                disc_fake_loss = self.model.discriminator.loss(
-                    tf.zeros_like(fake_predictions), fake_predictions
-                )
+        real_predictions, wrong_predictions, fake_predictions = self.discriminate(
+            [image_large, wrong_image_large, fake_images], text_tensor, training=False
+        )
 
-                discriminator_loss = (
-                    disc_real_loss + 0.5 * disc_wrong_loss + 0.5 * disc_fake_loss
-                )
+        assert (
+            real_predictions.shape
+            == wrong_predictions.shape
+            == fake_predictions.shape
+        ), "Real ({}), wrong ({}) and fake ({}) image predictions must have the same dimensions".format(
+            real_predictions.shape,
+            wrong_predictions.shape,
+            fake_predictions.shape,
+        )
 
-                # Update tqdm
-                t.set_postfix(
-                    kl_loss=float(kl_loss),
-                    generator_loss=float(generator_loss),
-                    discriminator_loss=float(discriminator_loss),
-                    disc_real_loss=float(disc_real_loss),
-                    disc_wrong_loss=float(disc_wrong_loss),
-                    disc_fake_loss=float(disc_fake_loss),
-                )
-                t.update()
+        generator_loss = tf.nn.compute_average_loss(
+            self.model.generator.loss(tf.ones_like(fake_predictions), fake_predictions)
+        )
+        kl_loss = tf.nn.scale_regularization_loss(sum(self.model.generator.losses))
+        generator_loss += kl_loss
 
-                # Accumulate losses over all samples
-                acc_generator_loss += generator_loss
-                acc_discriminator_loss += discriminator_loss
-                acc_kl_loss += kl_loss
-                acc_disc_real_loss += disc_real_loss
-                acc_disc_wrong_loss += disc_wrong_loss
-                acc_disc_fake_loss += disc_fake_loss
+        disc_real_loss = tf.nn.compute_average_loss(
+            self.model.discriminator.loss(
+                tf.ones_like(real_predictions), real_predictions
+            )
+        )
+        disc_wrong_loss = tf.nn.compute_average_loss(
+            self.model.discriminator.loss(
+                tf.zeros_like(wrong_predictions), wrong_predictions
+            )
+        )
+        disc_fake_loss = tf.nn.compute_average_loss(
+            self.model.discriminator.loss(
+                tf.zeros_like(fake_predictions), fake_predictions
+            )
+        )
 
-                # if batch_idx == 1:
-                #     break
+        discriminator_loss = (
+            disc_real_loss + 0.5 * disc_wrong_loss + 0.5 * disc_fake_loss
+        )
 
-        return {
-            "generator_loss": np.asscalar(acc_generator_loss.numpy()) / (batch_idx + 1),
-            "discriminator_loss": np.asscalar(acc_discriminator_loss.numpy())
-            / (batch_idx + 1),
-            "kl_loss": np.asscalar(acc_kl_loss.numpy()) / (batch_idx + 1),
-            "discriminator_real_loss": np.asscalar(acc_disc_real_loss.numpy())
-            / (batch_idx + 1),
-            "discriminator_wrong_loss": np.asscalar(acc_disc_wrong_loss.numpy())
-            / (batch_idx + 1),
-            "discriminator_fake_loss": np.asscalar(acc_disc_fake_loss.numpy())
-            / (batch_idx + 1),
+        losses = {
+            "generator_loss": generator_loss,
+            "discriminator_loss": discriminator_loss,
+            "kl_loss": kl_loss,
+            "discriminator_real_loss": disc_real_loss,
+            "discriminator_wrong_loss": disc_wrong_loss,
+            "discriminator_fake_loss": disc_fake_loss,
         }
+        return losses, (real_predictions, wrong_predictions, fake_predictions)
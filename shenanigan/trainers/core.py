@@ -1,9 +1,20 @@
+import collections
+import functools
+import itertools
 import os
+import time
 import tensorflow as tf
+from tqdm import trange
+from typing import Callable, Dict, List, Tuple
 
+from shenanigan.metrics.accumulator import MetricsAccumulator, discriminator_statistics
+from shenanigan.utils.distribute import is_chief, peak_memory, worker_index
 from shenanigan.utils.logger import MetricsLogger
 from shenanigan.utils.model_helpers import Checkpointer
 
+# A train or validation step, returning its losses and statistics
+StepFn = Callable[..., Tuple[Dict[str, tf.Tensor], Dict[str, tf.Tensor]]]
+
 
 class Trainer(object):
     def __init__(
@@ -16,6 +27,13 @@ class Trainer(object):
         callbacks=None,
         use_pretrained: bool = False,
         show_progress_bar: bool = True,
+        strategy: tf.distribute.Strategy = None,
+        compile_steps: bool = False,
+        jit_compile: bool = False,
+        fused_discriminator: bool = False,
+        progress_every: int = 10,
+        accumulation_steps: int = 1,
+        async_checkpoints: bool = False,
     ):
         """ Initialise the model trainer
             Arguments:
@@ -26,7 +44,32 @@ class Trainer(object):
             save_location: str
                 The directory in which to save all
                 results from training the model.
+            strategy: tf.distribute.Strategy
+                The strategy the model was created with. Training steps run
+                on every replica of it. Defaults to the default device.
+            compile_steps: bool
+                Run the train and validation steps as tf.functions. The last,
+                partial, batch of each epoch is then dropped.
+            jit_compile: bool
+                Also compile the steps with XLA
+            fused_discriminator: bool
+                Discriminate the real, wrong and fake images in one pass, see discriminate.
+                Off by default
+            progress_every: int
+                Show the running metrics every this many steps. Reading them
+                waits for the device, so this should not be every step.
+            accumulation_steps: int
+                Split each replica's batch into this many micro-batches, and
+                update the networks once with their accumulated gradients, see train_step
+            async_checkpoints: bool
+                Write the checkpoints on a background thread, so that the
+                training loop only waits for the variables to be copied
         """
+        self.strategy = strategy if strategy is not None else tf.distribute.get_strategy()
+        self.check_batch_size(model, batch_size, accumulation_steps)
+        if not is_chief():
+            # Every worker has to save checkpoints, only the chief's are kept in save_location
+            save_location = os.path.join(save_location, "workers", str(worker_index()))
         self.model = model
         self.batch_size = batch_size
         self.save_dir = save_location
@@ -38,6 +81,12 @@ class Trainer(object):
         self.val_logger = MetricsLogger(
             os.path.join(self.save_dir, "val.csv"), use_pretrained
         )
+        self.train_histogram_logger = MetricsLogger(
+            os.path.join(self.save_dir, "train_histograms.csv"), use_pretrained
+        )
+        self.val_histogram_logger = MetricsLogger(
+            os.path.join(self.save_dir, "val_histograms.csv"), use_pretrained
+        )
         self.show_progress_bar = show_progress_bar
         self.callbacks = callbacks if callbacks is not None else []
         self.use_pretrained = use_pretrained
@@ -48,12 +97,26 @@ class Trainer(object):
             model=self.model,
             save_dir=os.path.join(self.save_dir, "ckpts_best"),
             max_keep=3,
+            async_write=async_checkpoints,
         )
         self.save_every_checkpointer = Checkpointer(
             model=self.model,
             save_dir=os.path.join(self.save_dir, "ckpts_every"),
             max_keep=20,
+            async_write=async_checkpoints,
         )
+        self.compile_steps = compile_steps
+        self.jit_compile = jit_compile
+        self.fused_discriminator = fused_discriminator
+        self.progress_every = progress_every
+        self.accumulation_steps = accumulation_steps
+        # The running metrics of each step function, see run_step
+        self.accumulators = {}
+        self.step_retraces = collections.Counter()
+        self._compiled_steps = {}
+        self._called_steps = set()
+        self._distributed_batches = {}
+        self._reported_drops = set()
 
     def __call__(self, train_loader: object, val_loader: object, num_epochs: int):
         """ Trains the model.
@@ -79,21 +142,33 @@ class Trainer(object):
             train_metrics["epoch"] = int(self.save_every_checkpointer.get_epoch_num())
             print(f"Metrics: {train_metrics}")
             self.train_logger(train_metrics)
+            train_histograms = self.accumulators["train_step"].histograms()
+            self.train_histogram_logger(
+                {"epoch": train_metrics["epoch"], **train_histograms}
+            )
             # Validation
             val_metrics = self.val_epoch(
                 val_loader, self.save_every_checkpointer.get_epoch_num()
             )
             val_metrics["epoch"] = int(self.save_every_checkpointer.get_epoch_num())
             print(f"Metrics: {val_metrics}")
+            if self.compile_steps:
+                print(f"Step retraces: {dict(self.step_retraces)}")
             self.val_logger(val_metrics)
+            val_histograms = self.accumulators["val_step"].histograms()
+            self.val_histogram_logger({"epoch": val_metrics["epoch"], **val_histograms})
             # update loss
             self.save_best_checkpointer.update_loss(train_metrics[self.tracking_metric])
             self.save_every_checkpointer.update_loss(
                 train_metrics[self.tracking_metric]
             )
-            # Save
+            # Save. A best checkpoint linked last epoch is linked now, its files
+            # have been written in the background while this epoch ran
+            self.save_best_checkpointer.complete_link()
+            saved_every = False
             if ((self.save_every_checkpointer.get_epoch_num()) % self.save_every) == 0:
                 save_path = self.save_every_checkpointer.save()
+                saved_every = True
                 print(
                     "Saved checkpoint for step {}: {}".format(
                         int(self.save_every_checkpointer.get_epoch_num()), save_path
@@ -102,7 +177,13 @@ class Trainer(object):
             if self.is_best(
                 train_metrics["generator_loss"]
             ):  # NOTE this should be validation but using train for now
-                save_path = self.save_best_checkpointer.save()
+                if saved_every:
+                    # The same variables, share the files instead of writing them twice
+                    save_path = self.save_best_checkpointer.link(
+                        self.save_every_checkpointer
+                    )
+                else:
+                    save_path = self.save_best_checkpointer.save()
                 print(
                     "Saved best checkpoint for step {}: {}".format(
                         int(self.save_best_checkpointer.get_epoch_num()), save_path
@@ -110,6 +191,10 @@ class Trainer(object):
                 )
             self.run_callbacks(self.save_every_checkpointer.get_epoch_num())
 
+        # Wait for the checkpoints still being written
+        self.save_every_checkpointer.flush()
+        self.save_best_checkpointer.flush()
+
     def train_epoch(self, train_loader: object, epoch_num: int):
         """ Training operations for a single epoch """
         pass
@@ -117,6 +202,311 @@ class Trainer(object):
     def val_epoch(self, val_loader: object, epoch_num: int):
         pass
 
+    def run_epoch(
+        self,
+        loader: object,
+        epoch_num: int,
+        step_fn: StepFn,
+        num_samples: int,
+        augment: bool,
+        img_size: str,
+    ) -> Dict[str, float]:
+        """ Run step_fn on every batch of the loader. Returns the average of the
+            losses it returns, and the discriminator's accuracy.
+            Arguments:
+            loader: ImageTextDataLoader
+                The loader to read the batches from
+            step_fn: callable
+                The train or validation step, called with one replica's
+                (image, wrong_image, text) batch. Returns the losses and the
+                discriminator_statistics of the batch.
+            num_samples, augment, img_size:
+                How to prepare the batches, see ImageTextDataLoader.prepared
+        """
+        # Compiled steps only see full batches, so that they are traced once.
+        # Virtual batch normalisation and micro-batches also need full batches.
+        drop_remainder = (
+            self.compile_steps
+            or self.model.discriminator.bn_virtual_batch_size is not None
+            or self.accumulation_steps > 1
+        )
+        num_batches = loader.num_batches(drop_remainder)
+        if num_batches == 0:
+            raise Exception(
+                f"The {loader.subset} subset has no {'full ' if drop_remainder else ''}"
+                f"batches of {loader.batch_size} examples to run an epoch on"
+            )
+        if drop_remainder and loader not in self._reported_drops:
+            self._reported_drops.add(loader)
+            num_dropped = loader.num_dropped_examples()
+            if num_dropped > 0:
+                print(
+                    f"Dropping the last partial batch of every {loader.subset} epoch, "
+                    f"{num_dropped} examples"
+                )
+        if self.strategy.num_replicas_in_sync == 1:
+            batches = loader.prepared(num_samples, augment, img_size, drop_remainder)
+            element_spec = batches.element_spec
+        else:
+            # With more than one replica every worker runs num_batches steps
+            if loader not in self._distributed_batches:
+                self._distributed_batches[loader] = iter(
+                    loader.distributed(
+                        self.strategy, num_samples, augment, img_size, drop_remainder
+                    )
+                )
+            element_spec = self._distributed_batches[loader].element_spec
+            batches = itertools.islice(self._distributed_batches[loader], num_batches)
+        if self.compile_steps:
+            step = self.compiled_step(step_fn, element_spec)
+        else:
+            step = functools.partial(self.run_step, step_fn)
+
+        accumulator = self.accumulators.setdefault(
+            step_fn.__name__, MetricsAccumulator(self.strategy)
+        )
+        accumulator.reset()
+        kwargs = dict(
+            desc="Epoch {}".format(epoch_num),
+            leave=False,
+            disable=not self.show_progress_bar,
+        )
+        start_time = time.perf_counter()
+        with trange(num_batches, **kwargs) as t:
+            for batch_idx, batch in enumerate(batches):
+                step(*batch)
+                # Update tqdm
+                if (batch_idx + 1) % self.progress_every == 0:
+                    t.set_postfix(**accumulator.result())
+                t.update()
+
+        metrics = accumulator.result()
+        # After result, which waits for the last step. The first epoch includes tracing
+        step_time = (time.perf_counter() - start_time) / num_batches
+        memory = peak_memory()
+        print(f"Step time: {step_time:.3f}s" + (f", peak memory: {memory}" if memory else ""))
+        return metrics
+
+    def run_step(self, step_fn: StepFn, *batch: tf.Tensor):
+        """ Run step_fn on every replica's share of the batch, and add its losses
+            and statistics to the step function's accumulator. step_fn returns its
+            losses averaged over the global batch, so their sum over the replicas
+            is the loss of the whole batch. Its statistics are counts, summed too.
+        """
+        per_replica_losses, per_replica_statistics = self.strategy.run(
+            step_fn, args=batch
+        )
+        losses, statistics = [
+            {
+                name: self.strategy.reduce(tf.distribute.ReduceOp.SUM, value, axis=None)
+                for name, value in per_replica_values.items()
+            }
+            for per_replica_values in [per_replica_losses, per_replica_statistics]
+        ]
+        self.accumulators[step_fn.__name__].update(losses, statistics)
+
+    def train_losses(
+        self, image: tf.Tensor, wrong_image: tf.Tensor, text_tensor: tf.Tensor
+    ) -> Tuple[Dict[str, tf.Tensor], Tuple[tf.Tensor, tf.Tensor, tf.Tensor]]:
+        """ The training losses of one replica's (micro-)batch, averaged over the
+            (micro-)batches of all replicas, and the discriminator's real, wrong and
+            fake predictions. The losses include generator_loss and discriminator_loss.
+        """
+        pass
+
+    def val_losses(
+        self, image: tf.Tensor, wrong_image: tf.Tensor, text_tensor: tf.Tensor
+    ) -> Tuple[Dict[str, tf.Tensor], Tuple[tf.Tensor, tf.Tensor, tf.Tensor]]:
+        """ As train_losses, for validation """
+        pass
+
+    def train_step(
+        self, *batch: tf.Tensor
+    ) -> Tuple[Dict[str, tf.Tensor], Dict[str, tf.Tensor]]:
+        """ Update the generator and discriminator with one replica's batch.
+            The batch is split into accumulation_steps micro-batches. The gradients
+            of their train_losses are averaged and applied once, so the update is
+            that of the whole batch.
+            Batch normalisation uses the statistics of each micro-batch, as if
+            that were the batch size, and updates its moving averages once per
+            micro-batch.
+            Returns the losses, averaged over the micro-batches, and the summed
+            discriminator_statistics.
+        """
+        generator = self.model.generator
+        discriminator = self.model.discriminator
+        losses, statistics = {}, {}
+        generator_gradients, discriminator_gradients = None, None
+        for micro_batch in self.micro_batches(batch):
+            # Each micro-batch starts after the previous one's gradients are
+            # computed, so that only one micro-batch's activations are kept
+            previous_gradients = (generator_gradients or []) + (
+                discriminator_gradients or []
+            )
+            with tf.control_dependencies(previous_gradients):
+                micro_batch = [tf.identity(x) for x in micro_batch]
+            with tf.GradientTape() as generator_tape, tf.GradientTape() as discriminator_tape:
+                micro_losses, predictions = self.train_losses(*micro_batch)
+                scaled_generator_loss = self.scale_loss(
+                    generator, micro_losses["generator_loss"]
+                )
+                scaled_discriminator_loss = self.scale_loss(
+                    discriminator, micro_losses["discriminator_loss"]
+                )
+            generator_gradients = self.add_gradients(
+                generator_gradients,
+                self.gradients(generator, generator_tape, scaled_generator_loss),
+            )
+            discriminator_gradients = self.add_gradients(
+                discriminator_gradients,
+                self.gradients(
+                    discriminator, discriminator_tape, scaled_discriminator_loss
+                ),
+            )
+            self.add_step_results(losses, statistics, micro_losses, predictions)
+
+        self.apply_gradients(generator, generator_gradients)
+        self.apply_gradients(discriminator, discriminator_gradients)
+        return losses, statistics
+
+    def val_step(
+        self, *batch: tf.Tensor
+    ) -> Tuple[Dict[str, tf.Tensor], Dict[str, tf.Tensor]]:
+        """ The val_losses of one replica's batch, averaged over its micro-batches,
+            and the summed discriminator_statistics
+        """
+        losses, statistics = {}, {}
+        for micro_batch in self.micro_batches(batch):
+            micro_losses, predictions = self.val_losses(*micro_batch)
+            self.add_step_results(losses, statistics, micro_losses, predictions)
+        return losses, statistics
+
+    def check_batch_size(
+        self, model: tf.keras.Model, batch_size: int, accumulation_steps: int
+    ):
+        """ Check that each replica's batch splits into accumulation_steps equal
+            micro-batches, and that those split into the discriminator's virtual
+            batches, if it uses them
+        """
+        num_replicas = self.strategy.num_replicas_in_sync
+        if batch_size % (num_replicas * accumulation_steps) != 0:
+            raise Exception(
+                f"The batch size ({batch_size}) must be divisible by the number of "
+                f"replicas ({num_replicas}) times accumulation_steps ({accumulation_steps})"
+            )
+        micro_batch_size = batch_size // (num_replicas * accumulation_steps)
+        bn_virtual_batch_size = getattr(model.discriminator, "bn_virtual_batch_size", None)
+        if bn_virtual_batch_size is not None and micro_batch_size % bn_virtual_batch_size != 0:
+            raise Exception(
+                f"The micro-batch size of each replica ({micro_batch_size}) must be "
+                f"divisible by the discriminator's bn_virtual_batch_size ({bn_virtual_batch_size})"
+            )
+
+    def micro_batches(self, batch: Tuple[tf.Tensor, ...]) -> List[List[tf.Tensor]]:
+        """ batch split into accumulation_steps equal micro-batches """
+        if self.accumulation_steps == 1:
+            return [list(batch)]
+        return [
+            list(micro_batch)
+            for micro_batch in zip(
+                *[tf.split(x, self.accumulation_steps, axis=0) for x in batch]
+            )
+        ]
+
+    def add_step_results(
+        self,
+        losses: Dict[str, tf.Tensor],
+        statistics: Dict[str, tf.Tensor],
+        micro_losses: Dict[str, tf.Tensor],
+        predictions: Tuple[tf.Tensor, tf.Tensor, tf.Tensor],
+    ):
+        """ Add a micro-batch's share of the losses, and its statistics """
+        for name, loss in micro_losses.items():
+            losses[name] = losses.get(name, 0.0) + loss / self.accumulation_steps
+        for name, value in discriminator_statistics(*predictions).items():
+            statistics[name] = statistics.get(name, 0.0) + value
+
+    def add_gradients(
+        self, gradients: List[tf.Tensor], micro_gradients: List[tf.Tensor]
+    ) -> List[tf.Tensor]:
+        """ Add a micro-batch's share of the gradients, gradients is None for the first """
+        micro_gradients = [g / self.accumulation_steps for g in micro_gradients]
+        if gradients is None:
+            return micro_gradients
+        return [g + micro_g for g, micro_g in zip(gradients, micro_gradients)]
+
+    def discriminate(
+        self, images: List[tf.Tensor], text_tensor: tf.Tensor, training: bool
+    ) -> List[tf.Tensor]:
+        """ The discriminator's predictions for each batch of images, all with
+            the same text. With fused_discriminator the batches are concatenated
+            and discriminated in a single pass, which also embeds the text once.
+            Its batch normalisation statistics are then those of all the batches
+            together, unless the discriminator has a bn_virtual_batch_size of
+            one batch, which keeps them per batch as with separate passes.
+        """
+        if not self.fused_discriminator:
+            return [
+                self.model.discriminator([x, text_tensor], training=training)
+                for x in images
+            ]
+        predictions = self.model.discriminator(
+            [tf.concat(images, axis=0), text_tensor], training=training
+        )
+        return tf.split(predictions, len(images), axis=0)
+
+    def scale_loss(self, network: tf.keras.Model, loss: tf.Tensor) -> tf.Tensor:
+        """ The loss to differentiate for network. Call it in the tape's context.
+            It is scaled if network's optimizer uses loss scaling.
+        """
+        if isinstance(network.optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+            return network.optimizer.get_scaled_loss(loss)
+        return loss
+
+    def gradients(
+        self, network: tf.keras.Model, tape: tf.GradientTape, scaled_loss: tf.Tensor
+    ) -> List[tf.Tensor]:
+        """ The gradients of a loss from scale_loss for network's variables, unscaled """
+        gradients = tape.gradient(scaled_loss, network.trainable_variables)
+        if isinstance(network.optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+            gradients = network.optimizer.get_unscaled_gradients(gradients)
+        return gradients
+
+    def apply_gradients(self, network: tf.keras.Model, gradients: List[tf.Tensor]):
+        """ Update network's variables with its gradients """
+        network.optimizer.apply_gradients(zip(gradients, network.trainable_variables))
+
+    def compiled_step(
+        self, step_fn: StepFn, element_spec: Tuple
+    ) -> Callable[..., None]:
+        """ run_step for step_fn as a tf.function, with the batches' element_spec
+            as its input signature. The function is created once per step_fn,
+            self.step_retraces counts how often it is traced again after its first call.
+        """
+        name = step_fn.__name__
+        if name not in self._compiled_steps:
+
+            def step(*batch):
+                # Python side effects only run while tracing. The first call traces
+                # twice if it creates the model and optimizer variables.
+                if name in self._called_steps:
+                    self.step_retraces[name] += 1
+                return self.run_step(step_fn, *batch)
+
+            # XLA is only asked for when requested, otherwise TensorFlow decides
+            function_options = {"jit_compile": True} if self.jit_compile else {}
+            compiled_step = tf.function(
+                step, input_signature=element_spec, **function_options
+            )
+
+            def counted_step(*batch):
+                compiled_step(*batch)
+                self._called_steps.add(name)
+
+            self.step_retraces[name] = 0
+            self._compiled_steps[name] = counted_step
+        return self._compiled_steps[name]
+
     def is_best(self, current_loss: float):
         if current_loss < self.minimum_loss:
             self.minimum_loss = current_loss
@@ -1,5 +1,8 @@
 from google_drive_downloader import GoogleDriveDownloader as gdd
+import hashlib
 import io
+import json
+from multiprocessing import Pool
 import numpy as np
 import os
 import pandas as pd
@@ -13,12 +16,35 @@ from typing import Any, List, Dict, Tuple, Optional, Iterable
 import urllib.request
 import zipfile
 
-from shenanigan.utils.utils import format_file_name, mkdir, normalise, read_pickle
+from shenanigan.utils.utils import (
+    chunk_list,
+    file_sha256,
+    format_file_name,
+    mkdir,
+    read_pickle,
+    remove_file,
+)
 
 NUM_COLOUR_CHANNELS = 3
 
 IMAGE_SIZE_CONVERSION = {76: 64, 304: 256}
 
+EXAMPLES_PER_SHARD = 256
+IMAGES_PER_WORKER_CHUNK = 64
+BUILD_WINDOW_SIZE = 1024
+BUILD_SEED = 1234
+
+IMAGE_ENCODINGS = ["png", "jpeg", "raw"]
+TABULAR_IMAGE_ENCODINGS = ["png", "jpeg"]
+JPEG_QUALITY = 95
+RECORD_COMPRESSIONS = [None, "GZIP", "ZLIB"]
+
+METADATA_FILE_NAME = "metadata.json"
+TABULAR_DTYPE = "float16"
+TABULAR_ENCODER_FILE_NAME = "tabular_encoder.json"
+# Whether the mismatched images are stored in each record or picked per batch
+WRONG_IMAGE_MODES = ["stored", "batch"]
+
 
 def _int64_feature(value):
     """Returns an int64_list from a bool / enum / int / uint."""
@@ -52,6 +78,59 @@ def get_record_paths(root_dir: str) -> List[str]:
     return record_path_names
 
 
+def write_metadata(records_dir: str, metadata: Dict[str, Any]):
+    """ Save the metadata describing how the TFRecords in records_dir were built.
+        The file is replaced atomically, so an interrupted build never leaves
+        behind a partially written metadata file.
+    """
+    mkdir(records_dir)
+    metadata_path = os.path.join(records_dir, METADATA_FILE_NAME)
+    with open(f"{metadata_path}.tmp", "w") as metadata_file:
+        json.dump(metadata, metadata_file, indent=2)
+    os.replace(f"{metadata_path}.tmp", metadata_path)
+
+
+def read_metadata(records_dir: str) -> Dict[str, Any]:
+    """ Read the dataset metadata. Datasets built before metadata was
+        recorded have none, in which case an empty dict is returned.
+    """
+    metadata_path = os.path.join(records_dir, METADATA_FILE_NAME)
+    if not os.path.isfile(metadata_path):
+        return {}
+    with open(metadata_path, "r") as metadata_file:
+        return json.load(metadata_file)
+
+
+def manifest_record_paths(records_dir: str, subset: str) -> List[str]:
+    """ The paths of the TFRecords of a subset, listed in the dataset metadata.
+        Falls back to searching the subset directory if there is no manifest.
+    """
+    subset_metadata = read_metadata(records_dir).get("subsets", {}).get(subset)
+    if subset_metadata is None:
+        return sorted(get_record_paths(os.path.join(records_dir, subset)))
+    return [
+        os.path.join(records_dir, shard["path"])
+        for window in subset_metadata["windows"]
+        for shard in window["shards"]
+    ]
+
+
+def manifest_num_examples(records_dir: str, subset: str) -> Optional[int]:
+    """ The number of examples of a subset listed in the dataset metadata,
+        or None if there is no manifest.
+    """
+    subset_metadata = read_metadata(records_dir).get("subsets", {}).get(subset)
+    if subset_metadata is None:
+        return None
+    if "num_examples" in subset_metadata:
+        return subset_metadata["num_examples"]
+    return sum(
+        shard["num_examples"]
+        for window in subset_metadata["windows"]
+        for shard in window["shards"]
+    )
+
+
 def download_dataset(dataset: str):
     if dataset == "birds-with-text":
         download_cub()
@@ -191,8 +270,28 @@ def create_image_caption_tfrecords(
     bounding_boxes_path: str,
     image_dims_large: Tuple[int, int],
     image_dims_small: Tuple[int, int],
+    examples_per_shard: int = EXAMPLES_PER_SHARD,
+    bytes_per_shard: Optional[int] = None,
+    num_workers: int = 1,
+    window_size: int = BUILD_WINDOW_SIZE,
+    wrong_images: str = "stored",
+    image_encoding: str = "png",
+    jpeg_quality: int = JPEG_QUALITY,
+    compression: Optional[str] = None,
+    seed: int = BUILD_SEED,
+    verify_shards: bool = False,
+    check_sources: bool = False,
 ):
-    """ Create the TFRecords dataset for image-caption pairs
+    """ Create (or bring up to date) the TFRecords dataset for image-caption pairs.
+        The examples of each subset are split into windows, and each window is
+        written to its own shards. The metadata keeps a manifest of every window:
+        a fingerprint of its source data and the build parameters, as well as the
+        size and content hash of each of its shards. A window is only rebuilt if
+        its fingerprint has changed or its shards are missing (or modified), so
+        re-running the build resumes an interrupted build and only rebuilds the
+        windows affected by a change. Once every subset is complete and was built
+        with the same parameters, the source data is only read again (to find
+        the windows affected by a change) if check_sources is True.
         Arguments:
             tfrecords_dir: str
                 Root save location for the TFRecrods
@@ -202,8 +301,83 @@ def create_image_caption_tfrecords(
                 Root source directory from which to read the text
             image_dims: tuple
                 (height (int), width (int))
+            examples_per_shard: int
+                Maximum number of examples written to a single TFRecord shard
+            bytes_per_shard: int
+                Optional target size (in bytes) at which a new shard is started
+            num_workers: int
+                Number of processes used to preprocess the images
+            window_size: int
+                Number of examples whose images are held in memory at any one time
+            wrong_images: str
+                'stored' to save a mismatched (wrong) image pair in every record,
+                or 'batch' to only save the real images and pick the wrong images
+                from the rest of the batch when the dataset is read
+            image_encoding: str
+                How the images are stored: 'png', 'jpeg' or 'raw' (uint8 pixels)
+            jpeg_quality: int
+                Quality (1-95) used when image_encoding is 'jpeg'
+            compression: str
+                Optional compression of the TFRecord files, 'GZIP' or 'ZLIB'
+            seed: int
+                Seed for the window assignment and `wrong` image pairing, which
+                keeps the windows stable between builds
+            verify_shards: bool
+                Check the content hash of existing shards, rather than only their
+                size, before reusing them
+            check_sources: bool
+                Fingerprint the source data of a complete dataset, and rebuild
+                any windows whose source data has changed
     """
-    for subset in ["train", "test"]:
+    if wrong_images not in WRONG_IMAGE_MODES:
+        raise ValueError(
+            f"Invalid wrong_images mode '{wrong_images}', expected one of {WRONG_IMAGE_MODES}"
+        )
+    if image_encoding not in IMAGE_ENCODINGS:
+        raise ValueError(
+            f"Invalid image_encoding '{image_encoding}', expected one of {IMAGE_ENCODINGS}"
+        )
+    if compression not in RECORD_COMPRESSIONS:
+        raise ValueError(
+            f"Invalid compression '{compression}', expected one of {RECORD_COMPRESSIONS}"
+        )
+    preprocessing = "pad" if bounding_boxes_path is None else "crop"
+    build_parameters = {
+        "image_dims_large": list(image_dims_large),
+        "image_dims_small": list(image_dims_small),
+        "preprocessing": preprocessing,
+        "wrong_images": wrong_images,
+        "image_encoding": image_encoding,
+        "jpeg_quality": jpeg_quality,
+        "compression": compression,
+        "examples_per_shard": examples_per_shard,
+        "bytes_per_shard": bytes_per_shard,
+        "window_size": window_size,
+        "seed": seed,
+    }
+    if not check_sources and records_up_to_date(
+        tfrecords_dir, build_parameters, verify_shards
+    ):
+        return
+    previous_metadata = read_metadata(tfrecords_dir)
+    metadata = {
+        "wrong_images": wrong_images,
+        "image_encoding": image_encoding,
+        "jpeg_quality": jpeg_quality,
+        "compression": compression,
+        # NOTE: PIL dimensions are (width, height), image shapes are (H, W, C)
+        "image_shapes": {
+            "image_small": [image_dims_small[1], image_dims_small[0], NUM_COLOUR_CHANNELS],
+            "image_large": [image_dims_large[1], image_dims_large[0], NUM_COLOUR_CHANNELS],
+        },
+        "build_parameters": build_parameters,
+        # Subsets which have not been (re)built yet are kept, but marked incomplete
+        "subsets": {
+            subset: {**subset_manifest, "complete": False}
+            for subset, subset_manifest in previous_metadata.get("subsets", {}).items()
+        },
+    }
+    for subset_id, subset in enumerate(["train", "test"]):
         # Read from file and format
         file_names, labels, text_embeddings = read_text_subset(subset, text_source_dir)
         file_names = [
@@ -212,41 +386,387 @@ def create_image_caption_tfrecords(
         bb_map = extract_image_bounding_boxes(
             image_filenames=file_names, base_path=bounding_boxes_path
         )
-        # Convert to bytes
-        text_embeddings = [
-            text_embedding.tobytes() for text_embedding in text_embeddings
-        ]
-        # NOTE: Ideally we will have a default bb_map returned, but for now we have to skip
-        if bb_map is None:
-            images_large, images_small = get_byte_images(
-                image_paths=file_names,
-                large_image_dims=image_dims_large,
-                small_image_dims=image_dims_small,
-            )
-        else:
-            images_large, images_small = get_byte_images(
-                image_paths=file_names,
-                large_image_dims=image_dims_large,
-                small_image_dims=image_dims_small,
-                bounding_boxes=bb_map,
-                preprocessing="crop",
-            )
+        windows = build_label_windows(
+            labels, window_size, np.random.RandomState([seed, subset_id])
+        )
+        subset_manifest = write_subset_windows(
+            tfrecords_dir,
+            subset,
+            windows,
+            file_names,
+            labels,
+            text_embeddings,
+            bb_map,
+            build_parameters,
+            metadata,
+            previous_metadata,
+            num_workers=num_workers,
+            verify_shards=verify_shards,
+        )
+        label_values, label_counts = np.unique(labels, return_counts=True)
+        subset_manifest["label_histogram"] = {
+            str(label): int(count) for label, count in zip(label_values, label_counts)
+        }
+        subset_manifest["complete"] = True
+        write_metadata(tfrecords_dir, metadata)
+
+
+def write_subset_windows(
+    tfrecords_dir: str,
+    subset: str,
+    windows: List[np.ndarray],
+    file_names: List[bytes],
+    labels: List[int],
+    text_embeddings: List[np.ndarray],
+    bb_map: Optional[Dict],
+    build_parameters: Dict[str, Any],
+    metadata: Dict[str, Any],
+    previous_metadata: Dict[str, Any],
+    num_workers: int = 1,
+    verify_shards: bool = False,
+) -> Dict[str, Any]:
+    """ Write the shards of each window of a subset, unless the previous build
+        wrote a window with the same fingerprint whose shards are up to date.
+        The manifest of the subset is added to metadata, which is saved after
+        every window so that an interrupted build can be resumed. The caller
+        marks the returned manifest complete.
+    """
+    previous_windows = {
+        window["fingerprint"]: window
+        for window in previous_metadata.get("subsets", {}).get(subset, {}).get("windows", [])
+    }
+    subset_manifest = {"complete": False, "windows": []}
+    metadata["subsets"][subset] = subset_manifest
+
+    num_reused = 0
+    for window_idxs in windows:
+        fingerprint = window_fingerprint(
+            window_idxs, file_names, labels, text_embeddings, bb_map, build_parameters
+        )
+        previous_window = previous_windows.get(fingerprint)
+        if previous_window is not None and shards_up_to_date(
+            tfrecords_dir, previous_window["shards"], verify_shards
+        ):
+            subset_manifest["windows"].append(previous_window)
+            num_reused += 1
+            continue
+        # Images are read, encoded and written one window at a time
+        example_stream = stream_window_examples(
+            window_idxs=window_idxs,
+            file_names=file_names,
+            labels=labels,
+            text_embeddings=text_embeddings,
+            bb_map=bb_map,
+            image_dims_large=tuple(build_parameters["image_dims_large"]),
+            image_dims_small=tuple(build_parameters["image_dims_small"]),
+            num_workers=num_workers,
+            store_wrong_images=build_parameters["wrong_images"] == "stored",
+            image_encoding=build_parameters["image_encoding"],
+            jpeg_quality=build_parameters["jpeg_quality"],
+            random_state=np.random.RandomState(int(fingerprint[:8], 16)),
+        )
+        shards = write_records_to_file(
+            example_stream,
+            subset,
+            tfrecords_dir,
+            examples_per_shard=build_parameters["examples_per_shard"],
+            bytes_per_shard=build_parameters["bytes_per_shard"],
+            compression=build_parameters["compression"],
+            shard_prefix=f"{subset}-{fingerprint[:16]}",
+        )
+        for shard in shards:
+            shard_path = os.path.join(tfrecords_dir, shard["path"])
+            shard["size"] = os.path.getsize(shard_path)
+            shard["sha256"] = file_sha256(shard_path)
+        subset_manifest["windows"].append({"fingerprint": fingerprint, "shards": shards})
+        # Record progress after every window so that a crash can be resumed
+        write_metadata(tfrecords_dir, metadata)
+
+    remove_unlisted_records(tfrecords_dir, subset, subset_manifest["windows"])
+    subset_manifest["num_examples"] = len(labels)
+    print(
+        f"Subset '{subset}': reused {num_reused} and built {len(windows) - num_reused} of {len(windows)} windows"
+    )
+    return subset_manifest
+
+
+def window_fingerprint(
+    window_idxs: np.ndarray,
+    file_names: List[bytes],
+    labels: List[int],
+    text_embeddings: List[np.ndarray],
+    bb_map: Optional[Dict],
+    build_parameters: Dict[str, Any],
+) -> str:
+    """ Hash everything that determines the records of a window: the build
+        parameters and, for each of its examples, the image file (by name, size
+        and modification time), label, text embedding and bounding box.
+    """
+    window_hash = hashlib.sha256(
+        json.dumps(build_parameters, sort_keys=True).encode("utf-8")
+    )
+    for idx in window_idxs:
+        file_stat = os.stat(file_names[idx])
+        window_hash.update(file_names[idx])
+        window_hash.update(
+            f"{file_stat.st_size}:{file_stat.st_mtime_ns}:{labels[idx]}".encode("utf-8")
+        )
+        window_hash.update(np.ascontiguousarray(text_embeddings[idx]).tobytes())
+        if bb_map is not None:
+            window_hash.update(str(bb_map[file_names[idx]]).encode("utf-8"))
+    return window_hash.hexdigest()
+
+
+def records_up_to_date(
+    tfrecords_dir: str, build_parameters: Dict[str, Any], verify: bool = False
+) -> bool:
+    """ Check that the metadata lists every subset as complete, built with
+        build_parameters, and that all of their shards are up to date.
+    """
+    metadata = read_metadata(tfrecords_dir)
+    if metadata.get("build_parameters") != build_parameters:
+        return False
+    for subset in ["train", "test"]:
+        subset_manifest = metadata.get("subsets", {}).get(subset, {})
+        if not subset_manifest.get("complete", False):
+            return False
+        for window in subset_manifest["windows"]:
+            if not shards_up_to_date(tfrecords_dir, window["shards"], verify):
+                return False
+    return True
+
+
+def shards_up_to_date(
+    tfrecords_dir: str, shards: List[Dict[str, Any]], verify: bool = False
+) -> bool:
+    """ Check that all shards still exist as they were written. By default only
+        the file sizes are compared, if verify is True the content hashes are too.
+    """
+    for shard in shards:
+        shard_path = os.path.join(tfrecords_dir, shard["path"])
+        if not os.path.isfile(shard_path) or os.path.getsize(shard_path) != shard["size"]:
+            return False
+        if verify and file_sha256(shard_path) != shard["sha256"]:
+            return False
+    return True
+
+
+def remove_unlisted_records(
+    tfrecords_dir: str, subset: str, windows: List[Dict[str, Any]]
+):
+    """ Remove any TFRecords of the subset which are not part of the manifest,
+        e.g. left over from windows which have since been rebuilt.
+    """
+    listed_paths = set(
+        os.path.join(tfrecords_dir, shard["path"])
+        for window in windows
+        for shard in window["shards"]
+    )
+    for record_path in get_record_paths(os.path.join(tfrecords_dir, subset)):
+        if record_path not in listed_paths:
+            remove_file(record_path)
+
+
+def stream_window_examples(
+    window_idxs: np.ndarray,
+    file_names: List[bytes],
+    labels: List[int],
+    text_embeddings: List[np.ndarray],
+    bb_map: Optional[Dict],
+    image_dims_large: Tuple[int, int],
+    image_dims_small: Tuple[int, int],
+    num_workers: int = 1,
+    store_wrong_images: bool = True,
+    image_encoding: str = "png",
+    jpeg_quality: int = JPEG_QUALITY,
+    random_state: Optional[np.random.RandomState] = None,
+) -> Iterable[Tuple]:
+    """ Yield the fields of each image-caption example in a window, in the order
+        expected by `write_records_to_file`. Only the images of this window are
+        held in memory, and the `wrong` images are drawn from within the window.
+        If store_wrong_images is False, the wrong images are yielded as None.
+    """
+    window_file_names = [file_names[idx] for idx in window_idxs]
+    window_labels = [labels[idx] for idx in window_idxs]
+    # NOTE: Ideally we will have a default bb_map returned, but for now we have to skip
+    images_large, images_small = get_byte_images(
+        image_paths=window_file_names,
+        large_image_dims=image_dims_large,
+        small_image_dims=image_dims_small,
+        preprocessing="pad" if bb_map is None else "crop",
+        num_workers=num_workers,
+        image_encoding=image_encoding,
+        jpeg_quality=jpeg_quality,
+        bounding_boxes=bb_map,
+    )
+    if store_wrong_images:
         wrong_images_large, wrong_images_small = get_wrong_images(
-            large_images=images_large, small_images=images_small, labels=labels
+            large_images=images_large,
+            small_images=images_small,
+            labels=window_labels,
+            random_state=random_state,
+        )
+    else:
+        wrong_images_large = wrong_images_small = [None] * len(window_idxs)
+    for window_idx, idx in enumerate(window_idxs):
+        yield (
+            file_names[idx],
+            images_small[window_idx],
+            images_large[window_idx],
+            wrong_images_small[window_idx],
+            wrong_images_large[window_idx],
+            text_embeddings[idx].tobytes(),
+            labels[idx],
         )
-        # Arrange and write to file
-        shard_iterator = zip(
-            *[
-                file_names,
-                images_small,
-                images_large,
-                wrong_images_small,
-                wrong_images_large,
-                text_embeddings,
-                labels,
-            ]
+
+
+def build_windows(num_examples: int, window_size: int) -> List[List[int]]:
+    """ Split the indices [0, num_examples) into consecutive windows of window_size.
+        Any remainder is folded into the final window rather than forming a
+        (potentially tiny) window of its own.
+    """
+    if window_size < 1:
+        raise ValueError(f"window_size must be a positive integer, received {window_size}")
+    indices = list(range(num_examples))
+    if num_examples <= window_size:
+        return [indices]
+    return chunk_list(indices, window_size, (num_examples // window_size) * window_size)
+
+
+def build_label_windows(
+    labels: List[int],
+    window_size: int,
+    random_state: Optional[np.random.RandomState] = None,
+) -> List[np.ndarray]:
+    """ Split the examples into windows of (roughly) window_size example indices,
+        within which the `wrong` images can be paired up.
+        The examples are visited in a random, label-stratified order, so that every
+        window has close to the label distribution of the whole dataset. Any window
+        in which a label makes up more than half of the examples (so that no valid
+        pairing exists) is merged with its neighbours. Hence a window only lacks a
+        valid pairing if the dataset as a whole does.
+    """
+    labels = np.asarray(labels)
+    order = stratified_label_order(labels, random_state)
+    windows = []
+    pending = np.array([], dtype=int)
+    for window in build_windows(len(labels), window_size):
+        pending = np.concatenate([pending, order[window]])
+        if has_label_derangement(labels[pending]):
+            windows.append(pending)
+            pending = np.array([], dtype=int)
+    while len(pending) > 0 and windows and not has_label_derangement(labels[pending]):
+        pending = np.concatenate([windows.pop(), pending])
+    if len(pending) > 0:
+        windows.append(pending)
+    return windows
+
+
+def stratified_label_order(
+    labels: np.ndarray, random_state: Optional[np.random.RandomState] = None
+) -> np.ndarray:
+    """ Return a random ordering of the indices of labels in which each label is
+        spread evenly. Each example is keyed by its (randomly offset) rank within
+        its label, divided by the size of that label, and the keys are sorted.
+    """
+    random_state = np.random if random_state is None else random_state
+    num_examples = len(labels)
+    shuffled_idxs = random_state.permutation(num_examples)
+    _, label_ids, label_counts = np.unique(
+        labels[shuffled_idxs], return_inverse=True, return_counts=True
+    )
+    label_ids = label_ids.reshape(-1)
+    by_label = np.argsort(label_ids, kind="stable")
+    label_starts = np.cumsum(label_counts) - label_counts
+    ranks = np.empty(num_examples)
+    ranks[by_label] = np.arange(num_examples) - np.repeat(label_starts, label_counts)
+    offsets = random_state.uniform(size=len(label_counts))
+    keys = (ranks + offsets[label_ids]) / label_counts[label_ids]
+    return shuffled_idxs[np.argsort(keys, kind="stable")]
+
+
+def write_image_caption_memmaps(
+    example_iterable: Iterable[Dict[str, np.ndarray]],
+    num_examples: int,
+    memmap_dir: str,
+    image_shapes: Dict[str, List[int]],
+    text_embedding_dim: int,
+    wrong_index_seed: Optional[int] = None,
+):
+    """ Write decoded image-caption examples to memory-mapped .npy arrays:
+            images_small, images_large: (N, H, W, C) uint8
+            text: (total number of captions, embedding size) float32
+            text_offsets: (N + 1,) int64, the captions of example i are the rows
+                text[text_offsets[i]:text_offsets[i + 1]]
+            labels: (N,) int64, names: (N,) bytes
+            wrong_index: (N,) int64, the `wrong` partner of each example. Only
+                written if wrong_index_seed is given.
+        The arrays are written under temporary names and only renamed once
+        every example has been written.
+        Arguments:
+            example_iterable: iterable
+                Yields dicts with the (numpy) image_small, image_large, text,
+                name and label of each example
+            num_examples: int
+                The number of examples yielded by example_iterable
+            memmap_dir: str
+                Directory in which to save the arrays
+            image_shapes: dict
+                (H, W, C) shape of the image_small and image_large images
+            text_embedding_dim: int
+                Size of a single caption embedding
+            wrong_index_seed: int
+                Seed used to pair up the `wrong` examples
+    """
+    mkdir(memmap_dir)
+    images = {
+        image_name: np.lib.format.open_memmap(
+            os.path.join(memmap_dir, f"{image_name}.npy.tmp"),
+            mode="w+",
+            dtype=np.uint8,
+            shape=(num_examples, *image_shapes[image_name]),
         )
-        write_records_to_file(shard_iterator, subset, tfrecords_dir)
+        for image_name in ["image_small", "image_large"]
+    }
+    text = None
+    text_offsets = np.zeros(num_examples + 1, dtype=np.int64)
+    labels = np.zeros(num_examples, dtype=np.int64)
+    names = []
+    for idx, example in enumerate(example_iterable):
+        for image_name, image_memmap in images.items():
+            image_memmap[idx] = example[image_name]
+        captions = np.reshape(example["text"], (-1, text_embedding_dim))
+        if text is None:
+            # NOTE: Assumes that every example has the same number of captions
+            text = np.lib.format.open_memmap(
+                os.path.join(memmap_dir, "text.npy.tmp"),
+                mode="w+",
+                dtype=np.float32,
+                shape=(num_examples * captions.shape[0], captions.shape[1]),
+            )
+        if text_offsets[idx] + captions.shape[0] > text.shape[0]:
+            raise Exception("Every example must have the same number of captions")
+        text_offsets[idx + 1] = text_offsets[idx] + captions.shape[0]
+        text[text_offsets[idx] : text_offsets[idx + 1]] = captions
+        labels[idx] = example["label"]
+        names.append(example["name"])
+    if len(names) != num_examples:
+        raise Exception(f"Expected {num_examples} examples, but read {len(names)}")
+
+    for memmap in [*images.values(), text]:
+        memmap.flush()
+    del images, text
+    for array_name in ["image_small", "image_large", "text"]:
+        os.replace(
+            os.path.join(memmap_dir, f"{array_name}.npy.tmp"),
+            os.path.join(memmap_dir, f"{array_name.replace('image_', 'images_')}.npy"),
+        )
+    np.save(os.path.join(memmap_dir, "text_offsets.npy"), text_offsets)
+    np.save(os.path.join(memmap_dir, "labels.npy"), labels)
+    np.save(os.path.join(memmap_dir, "names.npy"), np.array(names, dtype=bytes))
+    if wrong_index_seed is not None:
+        wrong_index = label_derangement(labels, np.random.RandomState(wrong_index_seed))
+        np.save(os.path.join(memmap_dir, "wrong_index.npy"), wrong_index)
 
 
 def extract_image_bounding_boxes(
@@ -263,8 +783,12 @@ def extract_image_bounding_boxes(
 
 
 def extract_bounding_boxes_from_file(
-    image_filenames: str, base_path: str
-) -> Dict[str, Tuple]:
+    image_filenames: List[bytes], base_path: str
+) -> Dict[bytes, List[int]]:
+    """ Map each image filename to its bounding box. The bounding boxes are indexed
+        once by their relative filename (`<class dir>/<image name>`), so that each
+        image is a single dictionary lookup.
+    """
     bb_df = pd.read_csv(
         os.path.join(base_path, "bounding_boxes.txt"),
         names=["idx", "x", "y", "w", "h"],
@@ -274,80 +798,213 @@ def extract_bounding_boxes_from_file(
         os.path.join(base_path, "images.txt"), names=["idx", "filename"], sep=" "
     )
     combined_df = imgs_df.merge(bb_df, how="left", on="idx")
-    bb_map = {}
-    for idx, fn in enumerate(image_filenames):
-        bb_map[fn] = (
-            combined_df[
-                combined_df["filename"] == "/".join(fn.decode("utf-8").split("/")[-2:])
-            ]
-            .iloc[:, 2:]
-            .values.squeeze()
-            .astype(int)
-            .tolist()
+    bb_index = dict(
+        zip(
+            combined_df["filename"].values,
+            combined_df[["x", "y", "w", "h"]].values.astype(int).tolist(),
         )
+    )
+    bb_map = {}
+    for fn in image_filenames:
+        relative_fn = "/".join(fn.decode("utf-8").split("/")[-2:])
+        if relative_fn not in bb_index:
+            raise Exception(f"No bounding box found for image '{relative_fn}'")
+        bb_map[fn] = bb_index[relative_fn]
     return bb_map
 
 
 def get_wrong_images(
-    large_images: List[np.ndarray],
-    small_images: List[np.ndarray],
-    labels: List[np.ndarray],
-) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+    large_images: List[bytes],
+    small_images: List[bytes],
+    labels: List[int],
+    random_state: Optional[np.random.RandomState] = None,
+) -> Tuple[List[bytes], List[bytes]]:
     """ Generate images (large and small) which are in the incorrect order and therefore
         have the wrong order in their respective lists. The list order corresponds with
         the labels being incorrect i.e. `wrong` images.
+        NOTE: The returned lists reference the given images rather than copying them.
     """
-    labels = np.array(labels)
-    large_images = np.array(large_images)
-    wrong_idxs = np.array(list(range(0, len(labels))))
-    np.random.shuffle(wrong_idxs)
+    wrong_idxs = label_derangement(labels, random_state)
+    wrong_large_images = [large_images[idx] for idx in wrong_idxs]
+    wrong_small_images = [small_images[idx] for idx in wrong_idxs]
+    return wrong_large_images, wrong_small_images
 
-    error_counter = 0
-    while sum(labels == labels[wrong_idxs]) > 0:
-        if error_counter == 100:
-            raise Exception(
-                "Too many iterations in producing 'wrong' images, assuming will not converge"
-            )
-        collisions = labels == labels[wrong_idxs]
-        if sum(collisions) == 1:  # can allow for one duplicate
-            wrong_idxs[collisions] = np.random.randint(0, len(labels))
-        else:
-            wrong_idxs[collisions] = np.random.choice(
-                wrong_idxs[collisions], sum(collisions), replace=False
-            )
-        error_counter += 1
 
-    small_images = np.array(small_images)
-    return large_images[wrong_idxs].tolist(), small_images[wrong_idxs].tolist()
+def has_label_derangement(labels: np.ndarray) -> bool:
+    """ A permutation which moves every example onto one with a different label
+        exists if (and only if) no label makes up more than half of the examples.
+    """
+    if len(labels) == 0:
+        return True
+    _, label_counts = np.unique(labels, return_counts=True)
+    return 2 * label_counts.max() <= len(labels)
+
+
+def label_derangement(
+    labels: List[int], random_state: Optional[np.random.RandomState] = None
+) -> np.ndarray:
+    """ Return a permutation of the example indices which pairs every example with
+        an example of a different label. Runs in O(n log n) and never fails when
+        such a pairing exists.
+
+        The examples are shuffled and then (stably) sorted by label, so each label
+        occupies one contiguous block of at most m positions, where m is the size
+        of the largest label. Every sorted position p is paired with position
+        (p + shift) mod n, for a random shift in [m, n - m]. Both the forward
+        (shift) and backward (n - shift) distance between the two positions are at
+        least m, so they can never fall within the same block.
+    """
+    random_state = np.random if random_state is None else random_state
+    labels = np.asarray(labels)
+    num_examples = len(labels)
+    if not has_label_derangement(labels):
+        raise Exception(
+            "Unable to produce 'wrong' images, a single label makes up more than half of the examples"
+        )
+    if num_examples == 0:
+        return np.array([], dtype=int)
+
+    shuffled_idxs = random_state.permutation(num_examples)
+    sorted_idxs = shuffled_idxs[np.argsort(labels[shuffled_idxs], kind="stable")]
+    _, label_counts = np.unique(labels, return_counts=True)
+    max_count = label_counts.max()
+    shift = random_state.randint(max_count, num_examples - max_count + 1)
+
+    wrong_idxs = np.empty(num_examples, dtype=int)
+    wrong_idxs[sorted_idxs] = np.roll(sorted_idxs, -shift)
+    return wrong_idxs
 
 
 def create_image_tabular_tfrecords(
     tfrecords_dir: str,
     image_source_dir: str,
     text_source_dir: str,
-    image_dims: Tuple[int, int],
+    image_dims_large: Tuple[int, int],
+    image_dims_small: Tuple[int, int],
+    num_channels: int = 1,
+    examples_per_shard: int = EXAMPLES_PER_SHARD,
+    bytes_per_shard: Optional[int] = None,
+    num_workers: int = 1,
+    window_size: int = BUILD_WINDOW_SIZE,
+    wrong_images: str = "batch",
+    image_encoding: str = "png",
+    jpeg_quality: int = JPEG_QUALITY,
+    compression: Optional[str] = None,
+    seed: int = BUILD_SEED,
+    verify_shards: bool = False,
+    check_sources: bool = False,
+    tabular_dtype: str = TABULAR_DTYPE,
 ):
-    """ Create the TFRecords dataset for image-tabular pairs """
-    for subset in ["train", "valid"]:
-        image_prefix = f"CheXpert-v1.0-small/{subset}/"
-        # Tabular encoding
-        print("Creating tabular encoding")
-        tabular_df = load_tabular_data(os.path.join(image_source_dir, f"{subset}.csv"))
-        encoded_tabular_df = encode_tabular_data(tabular_df, image_prefix)
-        encoded_tabular_data, image_paths = extract_tabular_as_bytes_lists(
-            encoded_tabular_df,
-            prefix=os.path.join("data", "CheXpert-v1.0-small", "raw", subset),
+    """ Create (or bring up to date) the TFRecords dataset for image-tabular pairs.
+        The tabular encoder is fit on the train split, saved alongside the records
+        and applied to the valid split (stored as the test subset), so that both
+        are encoded with the same features. The encoded features are stored as
+        the `text` of each record, and every x-ray is its own class. The records
+        are written in windows and kept up to date as for image-caption datasets,
+        see create_image_caption_tfrecords, whose build options mean the same here.
+        Arguments:
+            tfrecords_dir: str
+                Root save location for the TFRecords
+            image_source_dir: str
+                Directory holding the {split}.csv files and {split} image directories
+            image_dims_large, image_dims_small: tuple
+                (width (int), height (int)) of the large and small images
+            num_channels: int
+                Number of channels the images are decoded to
+            image_encoding: str
+                How the images are stored: 'png' or 'jpeg'. The images are read
+                as RGB, so raw pixels could not be decoded to num_channels.
+            tabular_dtype: str
+                Data type in which the encoded tabular features are stored
+    """
+    if wrong_images not in WRONG_IMAGE_MODES:
+        raise ValueError(
+            f"Invalid wrong_images mode '{wrong_images}', expected one of {WRONG_IMAGE_MODES}"
+        )
+    if image_encoding not in TABULAR_IMAGE_ENCODINGS:
+        raise ValueError(
+            f"Invalid image_encoding '{image_encoding}' for an image-tabular dataset, "
+            f"expected one of {TABULAR_IMAGE_ENCODINGS}"
         )
-        # Convert to bytes
-        byte_images = get_byte_images(image_paths=image_paths, image_dims=image_dims)
-        # Arrange and write to file
-        print("Writing to TFRecords")
-        dummy_list = [0] * len(image_paths)
-        shard_iterator = zip(
-            *[image_paths, dummy_list, encoded_tabular_data, byte_images]
+    if compression not in RECORD_COMPRESSIONS:
+        raise ValueError(
+            f"Invalid compression '{compression}', expected one of {RECORD_COMPRESSIONS}"
+        )
+    build_parameters = {
+        "image_dims_large": list(image_dims_large),
+        "image_dims_small": list(image_dims_small),
+        "num_channels": num_channels,
+        "wrong_images": wrong_images,
+        "image_encoding": image_encoding,
+        "jpeg_quality": jpeg_quality,
+        "compression": compression,
+        "examples_per_shard": examples_per_shard,
+        "bytes_per_shard": bytes_per_shard,
+        "window_size": window_size,
+        "seed": seed,
+        "tabular_dtype": tabular_dtype,
+    }
+    if not check_sources and records_up_to_date(
+        tfrecords_dir, build_parameters, verify_shards
+    ):
+        return
+    mkdir(tfrecords_dir)
+    previous_metadata = read_metadata(tfrecords_dir)
+    metadata = {
+        "wrong_images": wrong_images,
+        "image_encoding": image_encoding,
+        "jpeg_quality": jpeg_quality,
+        "compression": compression,
+        # NOTE: PIL dimensions are (width, height), image shapes are (H, W, C)
+        "image_shapes": {
+            "image_small": [image_dims_small[1], image_dims_small[0], num_channels],
+            "image_large": [image_dims_large[1], image_dims_large[0], num_channels],
+        },
+        "text_dtype": tabular_dtype,
+        "build_parameters": build_parameters,
+        # Subsets which have not been (re)built yet are kept, but marked incomplete
+        "subsets": {
+            subset: {**subset_manifest, "complete": False}
+            for subset, subset_manifest in previous_metadata.get("subsets", {}).items()
+        },
+    }
+    encoder_path = os.path.join(tfrecords_dir, TABULAR_ENCODER_FILE_NAME)
+    for subset, split in [("train", "train"), ("test", "valid")]:
+        image_prefix = f"CheXpert-v1.0-small/{split}/"
+        tabular_df = load_tabular_data(os.path.join(image_source_dir, f"{split}.csv"))
+        if split == "train":
+            print("Fitting tabular encoding")
+            encoder = TabularEncoder(dtype=tabular_dtype).fit(tabular_df)
+            encoder.save(encoder_path)
+            metadata["num_text_features"] = encoder.num_features
+        else:
+            encoder = TabularEncoder.load(encoder_path)
+        # Tabular encoding, a change to it changes the fingerprints of the windows
+        print("Creating tabular encoding")
+        encoded_tabular_data = list(encoder.transform(tabular_df))
+        image_paths = [
+            os.path.join(
+                image_source_dir, split, remove_prefix(image_path, prefix=image_prefix)
+            ).encode("utf-8")
+            for image_path in tabular_df["Path"].values
+        ]
+        labels = list(range(len(image_paths)))
+        subset_manifest = write_subset_windows(
+            tfrecords_dir,
+            subset,
+            build_windows(len(image_paths), window_size),
+            image_paths,
+            labels,
+            encoded_tabular_data,
+            None,
+            build_parameters,
+            metadata,
+            previous_metadata,
+            num_workers=num_workers,
+            verify_shards=verify_shards,
         )
-        write_records_to_file(shard_iterator, subset, tfrecords_dir)
-        print("Complete")
+        subset_manifest["complete"] = True
+        write_metadata(tfrecords_dir, metadata)
 
 
 def get_byte_images(
@@ -355,9 +1012,14 @@ def get_byte_images(
     large_image_dims: Tuple[int, int],
     small_image_dims: Tuple[int, int],
     preprocessing: str = "pad",
+    num_workers: int = 1,
+    image_encoding: str = "png",
+    jpeg_quality: int = JPEG_QUALITY,
     **kwargs,
 ) -> Tuple[List[bytes], List[bytes]]:
-    """ Generate a list of byte representations of each image
+    """ Generate a list of byte representations of each image. If num_workers > 1,
+        the images are processed in chunks by a pool of processes. In either case
+        the output order matches the order of image_paths.
 
         if preprocessing == 'crop'
             Required: Dict[string, list] - bounding_boxes
@@ -366,27 +1028,88 @@ def get_byte_images(
     if bounding_boxes is None and preprocessing == "crop":
         raise Exception("bounding boxes required for preprocessing type 'crop'")
 
-    large_image_list = []
-    small_image_list = []
-    for image_path in image_paths:
-        new_img = get_image(image_path, large_image_dims, bounding_boxes, preprocessing)
-        byte_image = image_to_bytes(new_img)
-        large_image_list.append(byte_image)
-
-        new_img.thumbnail(small_image_dims, Image.ANTIALIAS)
-        downsampled_byte_image = image_to_bytes(new_img)
-        small_image_list.append(downsampled_byte_image)
+    # Only send each worker the bounding box of the image that it is processing
+    image_args = [
+        (
+            image_path,
+            large_image_dims,
+            small_image_dims,
+            None if bounding_boxes is None else {image_path: bounding_boxes[image_path]},
+            preprocessing,
+            image_encoding,
+            jpeg_quality,
+        )
+        for image_path in image_paths
+    ]
+    if num_workers > 1:
+        with Pool(processes=num_workers) as pool:
+            byte_image_pairs = pool.starmap(
+                get_byte_image_pair, image_args, chunksize=IMAGES_PER_WORKER_CHUNK
+            )
+    else:
+        byte_image_pairs = [get_byte_image_pair(*args) for args in image_args]
 
+    large_image_list = [large_image for large_image, _ in byte_image_pairs]
+    small_image_list = [small_image for _, small_image in byte_image_pairs]
     return large_image_list, small_image_list
 
 
-def image_to_bytes(img: Image) -> bytes:
+def get_byte_image_pair(
+    image_path: str,
+    large_image_dims: Tuple[int, int],
+    small_image_dims: Tuple[int, int],
+    bounding_boxes: Optional[dict],
+    preprocessing: str = "pad",
+    image_encoding: str = "png",
+    jpeg_quality: int = JPEG_QUALITY,
+) -> Tuple[bytes, bytes]:
+    """ Load and preprocess a single image, returning the byte representations
+        of the large image and its downsampled (small) version.
+    """
+    new_img = get_image(image_path, large_image_dims, bounding_boxes, preprocessing)
+    byte_image = image_to_bytes(new_img, image_encoding, jpeg_quality)
+
+    new_img.thumbnail(small_image_dims, Image.ANTIALIAS)
+    downsampled_byte_image = image_to_bytes(new_img, image_encoding, jpeg_quality)
+    return byte_image, downsampled_byte_image
+
+
+def image_to_bytes(
+    img: Image, image_encoding: str = "png", jpeg_quality: int = JPEG_QUALITY
+) -> bytes:
+    """ Encode an image as PNG, JPEG or raw uint8 pixels (in H, W, C order) """
+    if image_encoding == "raw":
+        return np.asarray(img, dtype=np.uint8).tobytes()
     img_buffer = io.BytesIO()
-    img.save(img_buffer, format="PNG")
+    if image_encoding == "png":
+        img.save(img_buffer, format="PNG")
+    elif image_encoding == "jpeg":
+        img.save(img_buffer, format="JPEG", quality=jpeg_quality)
+    else:
+        raise Exception(f"No method available for image encoding '{image_encoding}'")
     byte_image = img_buffer.getvalue()
     return byte_image
 
 
+def decode_image_bytes(
+    image_bytes: tf.Tensor, image_encoding: str = "png", shape: Optional[List[int]] = None
+) -> tf.Tensor:
+    """ Decode an image stored by `image_to_bytes` into a uint8 tensor. The shape
+        (H, W, C) is required for raw images and fixes the channels of the others.
+    """
+    channels = shape[-1] if shape is not None else 0
+    if image_encoding == "raw":
+        if shape is None:
+            raise Exception("The image shape is required to decode raw images")
+        return tf.reshape(tf.io.decode_raw(image_bytes, out_type=tf.uint8), shape)
+    elif image_encoding == "png":
+        return tf.io.decode_png(image_bytes, channels=channels)
+    elif image_encoding == "jpeg":
+        return tf.io.decode_jpeg(image_bytes, channels=channels)
+    else:
+        raise Exception(f"No method available for image encoding '{image_encoding}'")
+
+
 def get_image(
     image_path: str,
     image_dims: Tuple[int, int],
@@ -449,52 +1172,102 @@ def read_text_subset(
     return file_names, class_info, char_CNN_RNN_embeddings
 
 
+def create_image_caption_example(
+    file_name: bytes,
+    image_small: bytes,
+    image_large: bytes,
+    wrong_image_small: Optional[bytes],
+    wrong_image_large: Optional[bytes],
+    text_embedding: bytes,
+    label: int,
+) -> tf.train.Example:
+    """ Arrange a single image-caption sample as a tf.train.Example.
+        The wrong images are left out of the example if they are None.
+    """
+    feature = {
+        "image_small": _bytes_feature(image_small),
+        "image_large": _bytes_feature(image_large),
+        "name": _bytes_feature(file_name),
+        "text": _bytes_feature(text_embedding),
+        "label": _int64_feature(label),
+    }
+    if wrong_image_small is not None and wrong_image_large is not None:
+        feature["wrong_image_small"] = _bytes_feature(wrong_image_small)
+        feature["wrong_image_large"] = _bytes_feature(wrong_image_large)
+    return tf.train.Example(features=tf.train.Features(feature=feature))
+
+
 def write_records_to_file(
-    example_iterable: Iterable, subset_name: str, tfrecords_dir: str
-):
-    """ Save the TFRecord dataset with each example in its own TFRecord file.
+    example_iterable: Iterable,
+    subset_name: str,
+    tfrecords_dir: str,
+    examples_per_shard: int = EXAMPLES_PER_SHARD,
+    bytes_per_shard: Optional[int] = None,
+    compression: Optional[str] = None,
+    shard_prefix: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """ Save the TFRecord dataset as a sequence of shards, each holding many examples.
+        A new shard is started once the current one holds `examples_per_shard`
+        examples or, if given, once it has grown beyond `bytes_per_shard` bytes.
         Arguments:
             example_iterable: zip object (iterable)
-                Each iteration yields a tuple of 4 objects
+                Each iteration yields a tuple of 7 objects
             subset_name: str
                 Name of the subset (train/test)
             tfrecords_dir: str
                 Directory in which the save the TFRecords
+            examples_per_shard: int
+                Maximum number of examples in a shard
+            bytes_per_shard: int
+                Optional maximum number of (serialised, uncompressed) bytes in a shard
+            compression: str
+                Optional compression of the shards, 'GZIP' or 'ZLIB'
+            shard_prefix: str
+                File name prefix of the shards, defaults to the subset name
+        Returns:
+            For each shard written, its path (relative to tfrecords_dir)
+            and the number of examples it holds
     """
-    for (
-        i,
-        (
-            file_name,
-            image_small,
-            image_large,
-            wrong_image_small,
-            wrong_image_large,
-            text_embedding,
-            label,
-        ),
-    ) in enumerate(example_iterable):
-        example = tf.train.Example(
-            features=tf.train.Features(
-                feature={
-                    "image_small": _bytes_feature(image_small),
-                    "image_large": _bytes_feature(image_large),
-                    "wrong_image_small": _bytes_feature(wrong_image_small),
-                    "wrong_image_large": _bytes_feature(wrong_image_large),
-                    "name": _bytes_feature(file_name),
-                    "text": _bytes_feature(text_embedding),
-                    "label": _int64_feature(label),
-                }
-            )
+    if examples_per_shard < 1:
+        raise ValueError(
+            f"examples_per_shard must be a positive integer, received {examples_per_shard}"
         )
-
-        # Write a separate file to disk for each example
-        mkdir(os.path.join(tfrecords_dir, subset_name))
-        record_path_name = os.path.join(
-            tfrecords_dir, subset_name, "example-{}.tfrecord".format(i)
-        )
-        with tf.io.TFRecordWriter(record_path_name) as writer:
-            serialised_example = example.SerializeToString()
+    subset_dir = os.path.join(tfrecords_dir, subset_name)
+    mkdir(subset_dir)
+    shard_prefix = subset_name if shard_prefix is None else shard_prefix
+
+    shards = []
+    writer = None
+    shard_examples = 0
+    shard_bytes = 0
+    try:
+        for example_fields in example_iterable:
+            serialised_example = create_image_caption_example(
+                *example_fields
+            ).SerializeToString()
+            shard_full = shard_examples >= examples_per_shard or (
+                bytes_per_shard is not None and shard_bytes >= bytes_per_shard
+            )
+            if writer is None or shard_full:
+                if writer is not None:
+                    writer.close()
+                record_name = f"{shard_prefix}-{len(shards):05d}.tfrecord"
+                writer = tf.io.TFRecordWriter(
+                    os.path.join(subset_dir, record_name), options=compression
+                )
+                shards.append(
+                    {"path": os.path.join(subset_name, record_name), "num_examples": 0}
+                )
+                shard_examples = 0
+                shard_bytes = 0
             writer.write(serialised_example)
+            shards[-1]["num_examples"] += 1
+            shard_examples += 1
+            shard_bytes += len(serialised_example)
+    finally:
+        if writer is not None:
+            writer.close()
+    return shards
 
 
 def load_tabular_data(tabular_xray_path: str) -> pd.DataFrame:
@@ -516,53 +1289,101 @@ def build_encoding_map(column: pd.DataFrame) -> Dict[Any, int]:
     return encoding_map
 
 
-def encode_tabular_data(
-    tab_xray_df: pd.DataFrame, image_path_prefix: str
-) -> pd.DataFrame:
-    """ Encode the tabular data so that it is represented in one-hot
-        encoding for categorical variables, and normalised for continious
-        variables
-    """
-    ignores = ["Path"]
-    normalises = ["Age"]
-    encoded_df = pd.DataFrame({"Path": tab_xray_df["Path"].values})
-
-    for column in tab_xray_df:
-        if column not in ignores and column not in normalises:
-            # One-hot encode the categorical data
-            one_hot_subset_df = pd.get_dummies(tab_xray_df[column], prefix=column)
-            encoded_df = encoded_df.join(one_hot_subset_df)
-        if column in normalises and column not in ignores:
-            # Continious variable, simply normalise
-            norm_values = normalise(tab_xray_df[column].values)
-            encoded_df = encoded_df.join(pd.DataFrame({column: norm_values}))
-    encoded_df["Path"] = encoded_df["Path"].apply(
-        lambda x: remove_prefix(x, prefix=image_path_prefix)
-    )
-    return encoded_df
+class TabularEncoder(object):
+    """ Encodes tabular data into a fixed width feature vector: categorical
+        columns are one-hot encoded and continuous columns are scaled into [0,1].
+        The categories and ranges are fit once (on the train split) and then
+        applied unchanged to every split.
+    """
+
+    def __init__(
+        self,
+        ignores: List[str] = ["Path"],
+        continuous: List[str] = ["Age"],
+        dtype: str = TABULAR_DTYPE,
+    ):
+        self.ignores = list(ignores)
+        self.continuous = list(continuous)
+        self.dtype = dtype
+        # Categories of each categorical column in the order of their one-hot index
+        self.categories = {}
+        # (min, max) of each continuous column
+        self.ranges = {}
+
+    @property
+    def feature_names(self) -> List[str]:
+        """ Name of each encoded feature, e.g. Sex_Male """
+        return [
+            f"{column}_{category}"
+            for column, categories in self.categories.items()
+            for category in categories
+        ] + list(self.ranges.keys())
+
+    @property
+    def num_features(self) -> int:
+        return len(self.feature_names)
+
+    def fit(self, tabular_df: pd.DataFrame) -> "TabularEncoder":
+        """ Find the categories and ranges of the columns of tabular_df """
+        self.categories = {}
+        self.ranges = {}
+        for column in tabular_df:
+            if column in self.ignores:
+                continue
+            if column in self.continuous:
+                values = tabular_df[column].values.astype(np.float64)
+                self.ranges[column] = (float(values.min()), float(values.max()))
+            else:
+                self.categories[column] = list(build_encoding_map(tabular_df[column]))
+        return self
+
+    def transform(self, tabular_df: pd.DataFrame) -> np.ndarray:
+        """ Encode tabular_df into a (rows, num_features) array. Categories which
+            were not seen during fit are encoded as all zeros.
+        """
+        encoded = np.zeros((len(tabular_df), self.num_features), dtype=self.dtype)
+        row_idxs = np.arange(len(tabular_df))
+        offset = 0
+        for column, categories in self.categories.items():
+            codes = pd.Categorical(tabular_df[column], categories=categories).codes
+            known = codes >= 0
+            encoded[row_idxs[known], offset + codes[known]] = 1
+            offset += len(categories)
+        for column, (min_x, max_x) in self.ranges.items():
+            values = tabular_df[column].values.astype(np.float64)
+            encoded[:, offset] = (values - min_x) / max(max_x - min_x, 1e-12)
+            offset += 1
+        return encoded
+
+    def save(self, file_path: str):
+        """ Save the fitted encoding to a JSON file """
+        encoding = {
+            "ignores": self.ignores,
+            "continuous": self.continuous,
+            "dtype": self.dtype,
+            "categories": self.categories,
+            "ranges": self.ranges,
+        }
+        with open(file_path, "w") as encoding_file:
+            json.dump(encoding, encoding_file, indent=2)
+
+    @classmethod
+    def load(cls, file_path: str) -> "TabularEncoder":
+        """ Load an encoding saved with TabularEncoder.save """
+        with open(file_path) as encoding_file:
+            encoding = json.load(encoding_file)
+        encoder = cls(encoding["ignores"], encoding["continuous"], encoding["dtype"])
+        encoder.categories = encoding["categories"]
+        encoder.ranges = {
+            column: tuple(value_range) for column, value_range in encoding["ranges"].items()
+        }
+        return encoder
 
 
 def remove_prefix(name: str, prefix: str) -> str:
     return name[len(prefix) :]
 
 
-def extract_tabular_as_bytes_lists(
-    encoded_tabular_df: pd.DataFrame, prefix: str
-) -> Tuple[List[bytes], List[str]]:
-    """ Extract the image paths and feature data from the DataFrame.
-        These are converted to bytes and returned as separate lists.
-    """
-    image_paths = encoded_tabular_df["Path"].values
-    image_paths = [
-        os.path.join(prefix, image_path).encode("utf-8") for image_path in image_paths
-    ]
-    encoded_tabular_lists = encoded_tabular_df.loc[
-        :, encoded_tabular_df.columns != "Path"
-    ].values
-    encoded_tabular_lists = [sample.tobytes() for sample in encoded_tabular_lists]
-    return encoded_tabular_lists, image_paths
-
-
 def extract_flowers_labels(path: str) -> List[int]:
     return loadmat(path)["labels"][0, :].tolist()
 
@@ -575,105 +1396,119 @@ def extract_flowers_data_split(path: str) -> Tuple[List[int], List[int], List[in
     return train_ids, val_ids, test_ids
 
 
-def transform_image(img: tf.Tensor) -> tf.Tensor:
-    """ Apply a sequence of tranforms to an image.
-        Currently just normalisation.
+def transform_images(images: tf.Tensor) -> tf.Tensor:
+    """ Apply a sequence of transforms to a batch of images: each image is
+        independently flipped and cropped, then normalised.
     """
-    img = tf.image.random_flip_left_right(img)
-
-    if img.shape[0] not in IMAGE_SIZE_CONVERSION:
-        raise RuntimeError(f"Unsupported image size of {img.shape[0]}")
-
-    if len(img.shape) == 2:
-        img = tf.image.random_crop(
-            value=img,
-            size=(
-                IMAGE_SIZE_CONVERSION[img.shape[0]],
-                IMAGE_SIZE_CONVERSION[img.shape[1]],
-            ),
-        )
-    elif len(img.shape) == 3:
-        img = tf.image.random_crop(
-            value=img,
-            size=(
-                IMAGE_SIZE_CONVERSION[img.shape[0]],
-                IMAGE_SIZE_CONVERSION[img.shape[1]],
-                img.shape[2],
-            ),
-        )
-    else:
-        raise RuntimeError(f"Unsupported number of image channels {img.shape}")
-    return img * (2.0 / 255) - 1.0
-
-
-def extract_image_with_text(
-    sample: Dict[str, tf.Tensor],
-    index: int,
-    embedding_size: int,
-    num_embeddings_to_sample: int,
-    img_size: str,
-) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor]:
-    """ Return the image, wrong image, and sampled text embeddings """
-    image, wrong_image = extract_images(sample=sample, index=index, size=img_size)
-    txt = tf.reshape(sample["text"][index], (-1, embedding_size))
-    emb_idxs = np.random.choice(
-        txt.shape[0], size=num_embeddings_to_sample, replace=False
-    )
-    sampled_txt_embeddings = tf.math.reduce_mean(tf.gather(txt, emb_idxs), axis=0)
-    return image, wrong_image, sampled_txt_embeddings
-
-
-def extract_images(
-    sample: Dict[str, tf.Tensor], index: int, size: str
-) -> Tuple[tf.Tensor, tf.Tensor]:
-    """ NOTE: If include_wrong == False, then we return `None` in place """
-    if size in ["small", "large"]:
-        image = sample[f"image_{size}"][index]
-        wrong_image = sample[f"wrong_image_{size}"][index]
-        return image, wrong_image
-    else:
-        raise Exception(f"There are only two sizes: small and large. Received: {size}")
+    if len(images.shape) == 3:
+        # Images without a channel dimension
+        return transform_images(images[..., tf.newaxis])[..., 0]
+    if len(images.shape) != 4:
+        raise RuntimeError(f"Unsupported number of image channels {images.shape}")
+    if images.shape[1] not in IMAGE_SIZE_CONVERSION:
+        raise RuntimeError(f"Unsupported image size of {images.shape[1]}")
+
+    batch_size = tf.shape(images)[0]
+    height, width = images.shape[1], images.shape[2]
+    crop_height = IMAGE_SIZE_CONVERSION[height]
+    crop_width = IMAGE_SIZE_CONVERSION[width]
+    # Each image is cropped at a random offset by gathering its rows and columns,
+    # a flip simply reverses the order in which the columns are gathered
+    offset_y = tf.random.uniform([batch_size], 0, height - crop_height + 1, dtype=tf.int32)
+    offset_x = tf.random.uniform([batch_size], 0, width - crop_width + 1, dtype=tf.int32)
+    row_idxs = offset_y[:, tf.newaxis] + tf.range(crop_height)
+    col_idxs = offset_x[:, tf.newaxis] + tf.range(crop_width)
+    flips = tf.random.uniform([batch_size, 1]) < 0.5
+    col_idxs = tf.where(flips, tf.reverse(col_idxs, axis=[1]), col_idxs)
+    images = tf.gather(images, row_idxs, axis=1, batch_dims=1)
+    images = tf.gather(images, col_idxs, axis=2, batch_dims=1)
+    return images * (2.0 / 255) - 1.0
+
+
+def sample_text_embeddings(
+    text: tf.Tensor, embedding_size: int, num_embeddings_to_sample: int
+) -> tf.Tensor:
+    """ For each sample of a batch, average a random subset (without replacement)
+        of its caption embeddings.
+    """
+    batch_size = tf.shape(text)[0]
+    txt = tf.reshape(text, (batch_size, -1, embedding_size))
+    # The top k of uniform noise is a random selection of k captions per sample
+    selection_scores = tf.random.uniform(tf.shape(txt)[:2])
+    _, emb_idxs = tf.math.top_k(selection_scores, k=num_embeddings_to_sample)
+    sampled_txt = tf.gather(txt, emb_idxs, batch_dims=1)
+    return tf.math.reduce_mean(tf.cast(sampled_txt, dtype=tf.float32), axis=1)
 
 
-def tensors_from_sample(
+def prepare_batch(
     sample: Dict[str, tf.Tensor],
-    batch_size: int,
     text_embedding_size: int,
     num_samples: int,
     augment: bool,
     img_size: str,
 ) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor]:
-    """ Extract and format the input samples such that they are ready to be fed into the model """
-    image_tensor = []
-    wrong_image_tensor = []
-    text_tensor = []
-    for i in range(batch_size):
-        image, wrong_image, text = extract_image_with_text(
-            sample=sample,
-            index=i,
-            embedding_size=text_embedding_size,
-            num_embeddings_to_sample=num_samples,
-            img_size=img_size,
-        )
-        image = tf.cast(image, dtype=tf.float32)
-        wrong_image = tf.cast(wrong_image, dtype=tf.float32)
-        text = tf.cast(text, dtype=tf.float32)
-
-        if augment:
-            image = transform_image(image)
-            wrong_image = transform_image(wrong_image)
-
-        image_tensor.append(image)
-        wrong_image_tensor.append(wrong_image)
-        text_tensor.append(text)
-
-    image_tensor = tf.convert_to_tensor(image_tensor, dtype=tf.float32)
-    wrong_image_tensor = tf.convert_to_tensor(wrong_image_tensor, dtype=tf.float32)
-    text_tensor = tf.convert_to_tensor(text_tensor, dtype=tf.float32)
-
-    assert (
-        image_tensor.shape == wrong_image_tensor.shape
-    ), "Small real ({}) and wrong ({}) images must have the same dimensions".format(
-        image_tensor.shape, wrong_image_tensor.shape
+    """ Extract and format a batch of parsed samples such that they are ready to
+        be fed into the model. Runs in-graph, so that it can be mapped over a
+        batched tf.data.Dataset of parsed samples.
+        Arguments:
+            sample: dict
+                A batch of parsed samples
+            text_embedding_size: int
+                Size of a single caption embedding
+            num_samples: int
+                Number of caption embeddings to average per sample
+            augment: bool
+                Whether to flip, crop and normalise the images
+            img_size: str
+                Which images to use, small or large
+    """
+    if img_size not in ["small", "large"]:
+        raise Exception(f"There are only two sizes: small and large. Received: {img_size}")
+    image = tf.cast(sample[f"image_{img_size}"], dtype=tf.float32)
+    wrong_image = tf.cast(sample[f"wrong_image_{img_size}"], dtype=tf.float32)
+    text = sample_text_embeddings(sample["text"], text_embedding_size, num_samples)
+    if augment:
+        image = transform_images(image)
+        wrong_image = transform_images(wrong_image)
+    return image, wrong_image, text
+
+
+def batch_label_derangement(labels: tf.Tensor) -> tf.Tensor:
+    """ For a batch of labels, return the index of a `wrong` partner for each sample,
+        such that the partner has a different label wherever that is possible.
+        The samples are (stably) sorted by label and each is paired with the sample
+        which lies `largest class count` positions further along in the sorted
+        order. This never pairs two samples of the same label provided that no
+        label makes up more than half of the batch. Otherwise some samples are
+        paired with another sample of their label, but never with themselves:
+        if every sample has the same label, each is paired with the next one.
+    """
+    batch_size = tf.shape(labels)[0]
+    sorted_idxs = tf.argsort(labels, stable=True)
+    _, _, label_counts = tf.unique_with_counts(labels)
+    max_count = tf.reduce_max(label_counts)
+    # A shift of the whole batch would pair every sample with itself
+    shift = tf.where(max_count < batch_size, max_count, 1)
+    partner_idxs = tf.roll(sorted_idxs, shift=-shift, axis=0)
+    return tf.scatter_nd(
+        tf.expand_dims(sorted_idxs, axis=1), partner_idxs, shape=[batch_size]
     )
-    return image_tensor, wrong_image_tensor, text_tensor
+
+
+def add_batch_wrong_images(sample: Dict[str, tf.Tensor]) -> Dict[str, tf.Tensor]:
+    """ Build the wrong images of a batch by permuting the real images across
+        labels. Used for datasets whose records do not store wrong images.
+    """
+    wrong_idxs = batch_label_derangement(sample["label"])
+    for size in ["small", "large"]:
+        if f"image_{size}" in sample:
+            sample[f"wrong_image_{size}"] = tf.gather(sample[f"image_{size}"], wrong_idxs)
+    return sample
+
+
+def cast_images(sample: Dict[str, tf.Tensor]) -> Dict[str, tf.Tensor]:
+    """ Convert the (uint8) images of a sample to float32 """
+    for name in sample:
+        if "image" in name:
+            sample[name] = tf.cast(sample[name], dtype=tf.float32)
+    return sample
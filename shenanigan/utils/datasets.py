@@ -1,14 +1,30 @@
+import hashlib
+import json
+import math
+import numpy as np
 import os
 import pathlib
 import tensorflow as tf
+from typing import Iterable, List, Optional
 
 from shenanigan.utils.data_helpers import (
+    BUILD_SEED,
+    add_batch_wrong_images,
+    cast_images,
     check_for_xrays,
     create_image_caption_tfrecords,
+    decode_image_bytes,
     create_image_tabular_tfrecords,
     download_dataset,
     get_record_paths,
+    manifest_num_examples,
+    manifest_record_paths,
+    read_metadata,
+    write_image_caption_memmaps,
+    write_metadata,
 )
+from shenanigan.utils.distribute import task_name
+from shenanigan.utils.utils import mkdir, remove_file
 
 DATASETS_DICT = {
     "birds-with-text": "BirdsWithWordsDataset",
@@ -17,18 +33,72 @@ DATASETS_DICT = {
 }
 DATASETS = list(DATASETS_DICT.keys())
 AUTOTUNE = tf.data.experimental.AUTOTUNE
+INTERLEAVE_CYCLE_LENGTH = 8
+# Number of images of a batch which are decoded concurrently
+DECODE_PARALLEL_ITERATIONS = 8
+BACKENDS = ["tfrecord", "npy"]
+CACHE_MODES = ["none", "memory", "disk", "auto"]
+# Number of examples gathered at once when reading the memory-mapped arrays
+MEMMAP_GATHER_SIZE = 256
+# The features used to train each stage, all other features are not parsed
+STAGE_FEATURES = {
+    1: ["image_small", "wrong_image_small", "name", "text", "label"],
+    2: ["image_large", "wrong_image_large", "name", "text", "label"],
+}
 
 
 class StackGANDataset(object):
     """ Base class for all datasets """
 
-    def __init__(self):
+    def __init__(
+        self,
+        batch_first_parsing: bool = False,
+        num_parallel_calls: Optional[int] = None,
+        prefetch_batches: Optional[int] = None,
+        cache: str = "none",
+        cache_memory_budget_gb: float = 4.0,
+        **build_options,
+    ):
+        """ Any build_options (e.g. examples_per_shard) are forwarded to
+            the functions which create the TFRecords for the dataset.
+            Arguments:
+                batch_first_parsing: bool
+                    Batch the serialized examples before parsing them, rather
+                    than parsing every example on its own
+                num_parallel_calls: int
+                    Parallelism of the parsing and decoding map stages
+                    (None lets tf.data tune it)
+                prefetch_batches: int
+                    Number of batches to prefetch (None lets tf.data tune it)
+                cache: str
+                    Where to cache the decoded examples after the first epoch:
+                    none, memory, disk, or auto (memory if the subset fits
+                    in cache_memory_budget_gb, otherwise disk)
+                cache_memory_budget_gb: float
+                    Largest subset (in GB) which is cached in memory by 'auto'
+        """
+        if cache not in CACHE_MODES:
+            raise Exception(f"Invalid cache mode {cache}, expected one of {CACHE_MODES}")
+        self.batch_first_parsing = batch_first_parsing
+        self.num_parallel_calls = num_parallel_calls or AUTOTUNE
+        self.prefetch_batches = prefetch_batches or AUTOTUNE
+        self.cache = cache
+        self.cache_memory_budget = cache_memory_budget_gb * 2 ** 30
+        # Shared by all workers, so that they agree on the shard order of each epoch
+        self.shard_seed = build_options.get("seed", BUILD_SEED)
+        self.build_options = build_options
         self.type = None
         self.directory = None
         self.image_dims_small = (None, None)
         self.image_dims_large = (None, None)
         self.num_channels = None
         self.text_embedding_dim = None
+        # How the records are stored, updated from the dataset metadata when parsed
+        self.image_encoding = "png"
+        self.image_shapes = {}
+        self.compression = None
+        self.wrong_images = "stored"
+        self.text_dtype = tf.float32
 
         self.feature_description = {
             "image_small": tf.io.FixedLenFeature([], tf.string),
@@ -48,53 +118,449 @@ class StackGANDataset(object):
         """ Return in the form (dept, height, width) """
         return (self.num_channels, self.image_dims_large[1], self.image_dims_large[0])
 
-    def parse_dataset(self, subset: str = "train", batch_size: int = 1):
+    def parse_dataset(
+        self,
+        subset: str = "train",
+        batch_size: int = 1,
+        features: Optional[Iterable[str]] = None,
+        input_context: Optional[tf.distribute.InputContext] = None,
+    ):
         """ Parse the raw data from the TFRecords and arrange into a readable form
-            for the trainer object.
+            for the trainer object. If features is given (e.g. STAGE_FEATURES[1]),
+            only those features are parsed and decoded. If an input_context is
+            given, only this worker's share of the records is read.
+        """
+        if self.batch_first_parsing and self.cache == "none":
+            # Parse (and decode) whole batches of serialized examples at once
+            serialized_subset_obj = self.read_records(
+                subset, input_context=input_context
+            )
+            feature_description = self.select_features(features)
+            batched_subset_obj = (
+                serialized_subset_obj.shuffle(buffer_size=batch_size * 16)
+                .batch(batch_size)
+                .map(
+                    lambda example_protos: self._parse_batch(
+                        example_protos, feature_description
+                    ),
+                    num_parallel_calls=self.num_parallel_calls,
+                )
+            )
+        else:
+            cache_mode = self._cache_mode(subset, features, input_context)
+            if cache_mode == "disk":
+                mapped_subset_obj = self._disk_cached_examples(
+                    subset, features, batch_size, input_context
+                )
+            elif cache_mode == "memory":
+                mapped_subset_obj = self._memory_cached_examples(
+                    subset, features, batch_size, input_context
+                )
+            else:
+                mapped_subset_obj = self._decoded_examples(
+                    subset, features, batch_size, input_context=input_context
+                )
+            batched_subset_obj = mapped_subset_obj.shuffle(
+                buffer_size=batch_size * 16
+            ).batch(batch_size)
+        if self.wrong_images == "batch":
+            batched_subset_obj = batched_subset_obj.map(
+                add_batch_wrong_images, num_parallel_calls=self.num_parallel_calls
+            )
+        # Images are decoded (and cached) as uint8 and only converted once batched
+        batched_subset_obj = batched_subset_obj.map(
+            cast_images, num_parallel_calls=self.num_parallel_calls
+        )
+        return batched_subset_obj.prefetch(self.prefetch_batches)
+
+    def read_examples(
+        self,
+        subset: str,
+        shuffle_shards: bool = True,
+        features: Optional[Iterable[str]] = None,
+    ) -> tf.data.Dataset:
+        """ Read and decode the (unbatched) examples of a subset from its TFRecords.
+            If shuffle_shards is False, the examples are read in the order in
+            which they were written. If features is given, only those are parsed.
+        """
+        subset_obj = self.read_records(subset, shuffle_shards)
+        feature_description = self.select_features(features)
+        return subset_obj.map(
+            lambda example_proto: cast_images(
+                self._parse_example(example_proto, feature_description)
+            ),
+            num_parallel_calls=self.num_parallel_calls,
+        )
+
+    def num_examples(
+        self, subset: str, input_context: Optional[tf.distribute.InputContext] = None
+    ) -> int:
+        """ Number of examples in the TFRecords of a subset. If an input_context
+            is given, the (average) number of examples read by each worker.
+        """
+        num_examples = manifest_num_examples(self.directory, subset)
+        if num_examples is None:
+            # Records built without a manifest have to be counted
+            num_examples = sum(1 for _ in self.read_records(subset, shuffle_shards=False))
+        if input_context is not None:
+            return math.ceil(num_examples / input_context.num_input_pipelines)
+        return num_examples
+
+    def records_fingerprint(self, subset: str) -> str:
+        """ Hash of the TFRecords of a subset, which changes whenever they are rebuilt """
+        subset_metadata = read_metadata(self.directory).get("subsets", {}).get(subset)
+        if subset_metadata is None:
+            # Records without a manifest are identified by their files
+            subset_dir = os.path.join(str(self.directory), subset)
+            subset_metadata = [
+                (os.path.relpath(path, subset_dir), os.path.getsize(path), os.path.getmtime(path))
+                for path in sorted(get_record_paths(subset_dir))
+            ]
+        return hashlib.sha256(
+            json.dumps(subset_metadata, sort_keys=True).encode()
+        ).hexdigest()
+
+    def _decoded_examples(
+        self,
+        subset: str,
+        features: Optional[Iterable[str]],
+        batch_size: int,
+        shuffle_shards: bool = True,
+        input_context: Optional[tf.distribute.InputContext] = None,
+    ) -> tf.data.Dataset:
+        """ The (unbatched) examples of a subset with their images decoded to uint8 """
+        subset_obj = self.read_records(subset, shuffle_shards, input_context)
+        return self._parse_records(subset_obj, self.select_features(features), batch_size)
+
+    def _parse_records(
+        self, subset_obj: tf.data.Dataset, feature_description: dict, batch_size: int
+    ) -> tf.data.Dataset:
+        """ Parse serialized examples, and decode their images to uint8 """
+        if self.batch_first_parsing:
+            return subset_obj.batch(batch_size).map(
+                lambda example_protos: self._parse_batch(example_protos, feature_description),
+                num_parallel_calls=self.num_parallel_calls,
+            ).unbatch()
+        return subset_obj.map(
+            lambda example_proto: self._parse_example(example_proto, feature_description),
+            num_parallel_calls=self.num_parallel_calls,
+        )
+
+    def _cache_mode(
+        self,
+        subset: str,
+        features: Optional[Iterable[str]],
+        input_context: Optional[tf.distribute.InputContext] = None,
+    ) -> str:
+        """ Where the decoded examples of a subset are cached, resolving 'auto'
+            to memory if they fit in the memory budget and to disk otherwise
+        """
+        if self.cache != "auto":
+            return self.cache
+        subset_obj = self._decoded_examples(subset, features, 1, shuffle_shards=False)
+        example = next(iter(subset_obj.take(1)))
+        subset_size = self.num_examples(subset, input_context) * sum(
+            np.asarray(value.numpy()).nbytes for value in example.values()
+        )
+        cache_mode = "memory" if subset_size <= self.cache_memory_budget else "disk"
+        print(f"Caching the decoded {subset} subset ({subset_size / 2 ** 30:.2f}GB) on {cache_mode}")
+        return cache_mode
+
+    def _disk_cached_examples(
+        self,
+        subset: str,
+        features: Optional[Iterable[str]],
+        batch_size: int,
+        input_context: Optional[tf.distribute.InputContext] = None,
+    ) -> tf.data.Dataset:
+        """ The decoded examples of a subset, cached on disk shard by shard so that
+            the records are only read and decoded in the first epoch. The shard
+            caches are interleaved in a new order every epoch. Caches are named
+            after the records they were read from, caches of older records are
+            removed. Every worker and input pipeline caches its own share of the
+            shards in a directory of its own, so they never write the same files.
+        """
+        shard_paths = self._pipeline_shard_paths(subset, input_context)
+        pipeline_name = task_name()
+        if input_context is not None:
+            pipeline_name += "-pipeline-{}-of-{}".format(
+                input_context.input_pipeline_id, input_context.num_input_pipelines
+            )
+        cache_dir = os.path.join(os.path.dirname(str(self.directory)), "cache", pipeline_name)
+        mkdir(cache_dir)
+        records_key = f"{subset}-{self.records_fingerprint(subset)[:16]}"
+        feature_description = self.select_features(features)
+        features_key = hashlib.sha256(
+            json.dumps(sorted(feature_description)).encode()
+        ).hexdigest()[:8]
+        for file_name in os.listdir(cache_dir):
+            if file_name.startswith(f"{subset}-") and not file_name.startswith(records_key):
+                remove_file(os.path.join(cache_dir, file_name))
+        cache_prefix = os.path.join(cache_dir, f"{records_key}-{features_key}-")
+        # The pipeline keeps the same shards every epoch, so that its caches are reused
+        subset_obj = tf.data.Dataset.from_tensor_slices(shard_paths).shuffle(
+            buffer_size=len(shard_paths), reshuffle_each_iteration=True
+        )
+        return subset_obj.interleave(
+            lambda path: self._parse_records(
+                tf.data.TFRecordDataset(path, compression_type=self.compression or ""),
+                feature_description,
+                batch_size,
+            ).cache(tf.strings.join([cache_prefix, tf.strings.split(path, "/")[-1]])),
+            cycle_length=INTERLEAVE_CYCLE_LENGTH,
+            num_parallel_calls=AUTOTUNE,
+        )
+
+    def _memory_cached_examples(
+        self,
+        subset: str,
+        features: Optional[Iterable[str]],
+        batch_size: int,
+        input_context: Optional[tf.distribute.InputContext] = None,
+    ) -> tf.data.Dataset:
+        """ The decoded examples of a subset, cached in memory shard by shard so that
+            the records are only read and decoded in the first epoch. Every epoch
+            the examples are drawn from the shard caches in the order of a new
+            (seeded) permutation of all the examples' shard indices, so the
+            shuffle buffer does not need to hold a second copy of the subset.
+        """
+        shard_paths = self._pipeline_shard_paths(subset, input_context)
+        feature_description = self.select_features(features)
+        shard_objs = [
+            self._parse_records(
+                tf.data.TFRecordDataset(path, compression_type=self.compression or ""),
+                feature_description,
+                batch_size,
+            ).cache()
+            for path in shard_paths
+        ]
+        # The n-th occurrence of a shard's index selects the n-th example of the shard.
+        # Each shard has one more occurrence, which reaches its end and so completes
+        # its cache
+        shard_idxs = np.repeat(
+            np.arange(len(shard_paths), dtype=np.int64),
+            np.array(self._shard_num_examples(subset, shard_paths)) + 1,
+        )
+        shard_idx_obj = tf.data.Dataset.from_tensor_slices(shard_idxs).shuffle(
+            buffer_size=len(shard_idxs),
+            seed=self.shard_seed,
+            reshuffle_each_iteration=True,
+        )
+        return tf.data.Dataset.choose_from_datasets(
+            shard_objs, shard_idx_obj, stop_on_empty_dataset=False
+        )
+
+    def _pipeline_shard_paths(
+        self, subset: str, input_context: Optional[tf.distribute.InputContext] = None
+    ) -> List[str]:
+        """ The paths of the TFRecords of a subset which are cached by this input
+            pipeline. The shards are split between the pipelines the same way
+            every epoch.
         """
         if subset not in ["train", "test"]:
             raise Exception(
                 "Invalid subset type: {}, expected train or test".format(subset)
             )
-        subset_paths = get_record_paths(os.path.join(self.directory, subset))
-        subset_obj = tf.data.TFRecordDataset(subset_paths)
-        mapped_subset_obj = subset_obj.map(self._parse_example, num_parallel_calls=8)
-        return (
-            mapped_subset_obj.shuffle(buffer_size=batch_size * 16)
-            .batch(batch_size)
-            .prefetch(batch_size // 10)
+        self._load_metadata(subset)
+        subset_paths = manifest_record_paths(self.directory, subset)
+        if input_context is None or input_context.num_input_pipelines == 1:
+            return subset_paths
+        num_workers = input_context.num_input_pipelines
+        if len(subset_paths) < num_workers:
+            raise Exception(
+                f"Cannot split {len(subset_paths)} shards between {num_workers} workers"
+            )
+        return subset_paths[input_context.input_pipeline_id :: num_workers]
+
+    def _shard_num_examples(self, subset: str, shard_paths: List[str]) -> List[int]:
+        """ The number of examples in each of the given TFRecords of a subset """
+        subset_metadata = read_metadata(self.directory).get("subsets", {}).get(subset)
+        if subset_metadata is None:
+            # Records built without a manifest have to be counted
+            return [
+                sum(1 for _ in tf.data.TFRecordDataset(path, self.compression or ""))
+                for path in shard_paths
+            ]
+        num_examples = {
+            os.path.join(self.directory, shard["path"]): shard["num_examples"]
+            for window in subset_metadata["windows"]
+            for shard in window["shards"]
+        }
+        return [num_examples[path] for path in shard_paths]
+
+    def read_records(
+        self,
+        subset: str,
+        shuffle_shards: bool = True,
+        input_context: Optional[tf.distribute.InputContext] = None,
+    ) -> tf.data.Dataset:
+        """ Read the serialized examples of a subset from its TFRecords.
+            If an input_context is given, the shards are split between the input
+            pipelines (workers), see _shard_paths.
+        """
+        subset_obj = self._shard_paths(subset, shuffle_shards, input_context)
+        if shuffle_shards:
+            # Read several shards concurrently
+            return subset_obj.interleave(
+                lambda path: tf.data.TFRecordDataset(
+                    path, compression_type=self.compression or ""
+                ),
+                cycle_length=INTERLEAVE_CYCLE_LENGTH,
+                num_parallel_calls=AUTOTUNE,
+            )
+        return subset_obj.flat_map(
+            lambda path: tf.data.TFRecordDataset(
+                path, compression_type=self.compression or ""
+            )
         )
 
-    def _parse_example(self, example_proto):
-        # Parse the input tf.Example proto using self.feature_description
+    def _shard_paths(
+        self,
+        subset: str,
+        shuffle_shards: bool = True,
+        input_context: Optional[tf.distribute.InputContext] = None,
+    ) -> tf.data.Dataset:
+        """ The paths of the TFRecords of a subset. If an input_context is given,
+            only this worker's share of them. When shuffle_shards is True the
+            split changes every epoch, but every worker draws the same shard
+            order, so the workers always read disjoint shards.
+        """
+        if subset not in ["train", "test"]:
+            raise Exception(
+                "Invalid subset type: {}, expected train or test".format(subset)
+            )
+        self._load_metadata(subset)
+        subset_paths = manifest_record_paths(self.directory, subset)
+        subset_obj = tf.data.Dataset.from_tensor_slices(subset_paths)
+        num_workers = input_context.num_input_pipelines if input_context else 1
+        if shuffle_shards:
+            # Shuffle the shard order every epoch
+            subset_obj = subset_obj.shuffle(
+                buffer_size=len(subset_paths),
+                seed=self.shard_seed if num_workers > 1 else None,
+                reshuffle_each_iteration=True,
+            )
+        if num_workers > 1:
+            if len(subset_paths) < num_workers:
+                raise Exception(
+                    f"Cannot split {len(subset_paths)} shards between {num_workers} workers"
+                )
+            subset_obj = subset_obj.shard(num_workers, input_context.input_pipeline_id)
+        return subset_obj
+
+    def select_features(self, features: Optional[Iterable[str]] = None) -> dict:
+        """ The description of the features which have to be parsed from the records
+            in order to provide the requested features. Call after the metadata has
+            been loaded.
+        """
+        if features is None:
+            return dict(self.feature_description)
+        features = set(features)
+        if self.wrong_images == "batch":
+            # The wrong images are built from the real images of the batch
+            for size in ["small", "large"]:
+                if f"wrong_image_{size}" in features:
+                    features |= {f"image_{size}", "label"}
+        unknown_features = features - {
+            *self.feature_description,
+            "wrong_image_small",
+            "wrong_image_large",
+        }
+        if unknown_features:
+            raise Exception(f"Unknown features: {sorted(unknown_features)}")
+        return {
+            name: description
+            for name, description in self.feature_description.items()
+            if name in features
+        }
+
+    def _load_metadata(self, subset: str):
+        """ Update how the records are read from the dataset metadata """
+        metadata = read_metadata(self.directory)
+        if not metadata.get("subsets", {}).get(subset, {}).get("complete", True):
+            raise Exception(
+                f"The '{subset}' subset in {self.directory} has not been completely built"
+            )
+        self.image_encoding = metadata.get("image_encoding", "png")
+        self.image_shapes = metadata.get("image_shapes", {})
+        self.compression = metadata.get("compression")
+        self.wrong_images = metadata.get("wrong_images", "stored")
+        self.text_dtype = tf.as_dtype(metadata.get("text_dtype", "float32"))
+        if self.wrong_images == "batch":
+            # The records only hold the real images
+            self.feature_description.pop("wrong_image_small", None)
+            self.feature_description.pop("wrong_image_large", None)
+
+    def _parse_example(self, example_proto, feature_description: Optional[dict] = None):
+        # Parse the input tf.Example proto using the (selected) feature description
         parsed_features = tf.io.parse_single_example(
-            example_proto, self.feature_description
-        )
-        parsed_features["image_small"] = (
-            tf.io.decode_image(parsed_features["image_small"], dtype=tf.float32) * 255
-        )
-        parsed_features["image_large"] = (
-            tf.io.decode_image(parsed_features["image_large"], dtype=tf.float32) * 255
+            example_proto, feature_description or self.feature_description
         )
-        parsed_features["wrong_image_small"] = (
-            tf.io.decode_image(parsed_features["wrong_image_small"], dtype=tf.float32)
-            * 255
+        for image_name in [
+            "image_small",
+            "image_large",
+            "wrong_image_small",
+            "wrong_image_large",
+        ]:
+            if image_name in parsed_features:
+                parsed_features[image_name] = self._decode_image(
+                    parsed_features[image_name], image_name.replace("wrong_", "")
+                )
+        if "text" in parsed_features:
+            parsed_features["text"] = tf.io.decode_raw(
+                parsed_features["text"], out_type=self.text_dtype
+            )
+        return parsed_features
+
+    def _parse_batch(self, example_protos, feature_description: dict):
+        # Parse a batch of serialized tf.Example protos with a single op
+        parsed_features = tf.io.parse_example(example_protos, feature_description)
+        for image_name in [
+            "image_small",
+            "image_large",
+            "wrong_image_small",
+            "wrong_image_large",
+        ]:
+            if image_name in parsed_features:
+                parsed_features[image_name] = self._decode_images(
+                    parsed_features[image_name], image_name.replace("wrong_", "")
+                )
+        if "text" in parsed_features:
+            parsed_features["text"] = tf.io.decode_raw(
+                parsed_features["text"], out_type=self.text_dtype
+            )
+        return parsed_features
+
+    def _decode_images(self, batch_bytes: tf.Tensor, size_name: str) -> tf.Tensor:
+        """ Decode a batch of images """
+        if self.image_encoding == "raw" and self.image_shapes.get(size_name):
+            images = tf.io.decode_raw(batch_bytes, out_type=tf.uint8)
+            return tf.reshape(images, [-1, *self.image_shapes[size_name]])
+        return tf.map_fn(
+            lambda image_bytes: self._decode_image(image_bytes, size_name),
+            batch_bytes,
+            dtype=tf.uint8,
+            parallel_iterations=DECODE_PARALLEL_ITERATIONS,
         )
-        parsed_features["wrong_image_large"] = (
-            tf.io.decode_image(parsed_features["wrong_image_large"], dtype=tf.float32)
-            * 255
+
+    def _decode_image(self, image_bytes: tf.Tensor, size_name: str) -> tf.Tensor:
+        """ Decode an (uint8) image using the encoding recorded in the dataset metadata """
+        image = decode_image_bytes(
+            image_bytes, self.image_encoding, self.image_shapes.get(size_name)
         )
-        parsed_features["text"] = tf.io.decode_raw(
-            parsed_features["text"], out_type=tf.float32
+        # Static shapes let the batched augmentations pick their crop sizes
+        num_channels, height, width = (
+            self.get_small_dims() if size_name == "image_small" else self.get_large_dims()
         )
-        return parsed_features
+        image.set_shape(self.image_shapes.get(size_name) or [height, width, num_channels])
+        return image
 
 
 class BirdsWithWordsDataset(StackGANDataset):
     """ Container for the birds dataset which includes word captions """
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, **build_options):
+        super().__init__(**build_options)
         self.type = "images-with-captions"
         self.image_dims_small = (76, 76)
         self.image_dims_large = (304, 304)
@@ -104,18 +570,19 @@ class BirdsWithWordsDataset(StackGANDataset):
         self.directory = pathlib.Path(os.path.join("data/CUB_200_2011_with_text/"))
         if not os.path.isdir(self.directory):
             download_dataset(dataset="birds-with-text")
-            create_image_caption_tfrecords(
-                tfrecords_dir=os.path.join(self.directory, "records"),
-                image_source_dir=os.path.join(
-                    self.directory, "images", "CUB_200_2011", "images"
-                ),
-                text_source_dir=os.path.join(self.directory, "text"),
-                bounding_boxes_path=os.path.join(
-                    self.directory, "images", "CUB_200_2011"
-                ),
-                image_dims_large=self.image_dims_large,
-                image_dims_small=self.image_dims_small,
-            )
+        # Resumes a partial build, the source data is only checked for changes
+        # if check_sources is set
+        create_image_caption_tfrecords(
+            tfrecords_dir=os.path.join(self.directory, "records"),
+            image_source_dir=os.path.join(
+                self.directory, "images", "CUB_200_2011", "images"
+            ),
+            text_source_dir=os.path.join(self.directory, "text"),
+            bounding_boxes_path=os.path.join(self.directory, "images", "CUB_200_2011"),
+            image_dims_large=self.image_dims_large,
+            image_dims_small=self.image_dims_small,
+            **self.build_options,
+        )
 
         records_dir = os.path.join(self.directory, "records")
         if os.path.isdir(records_dir):
@@ -125,8 +592,8 @@ class BirdsWithWordsDataset(StackGANDataset):
 class FlowersWithWordsDataset(StackGANDataset):
     """ Container for the birds dataset which includes word captions """
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, **build_options):
+        super().__init__(**build_options)
         self.type = "images-with-captions"
         self.image_dims_small = (76, 76)
         self.image_dims_large = (304, 304)
@@ -136,14 +603,17 @@ class FlowersWithWordsDataset(StackGANDataset):
         self.directory = pathlib.Path(os.path.join("data/flowers_with_text/"))
         if not os.path.isdir(self.directory):
             download_dataset(dataset="flowers-with-text")
-            create_image_caption_tfrecords(
-                tfrecords_dir=os.path.join(self.directory, "records"),
-                image_source_dir=os.path.join(self.directory, "images"),
-                text_source_dir=os.path.join(self.directory, "text"),
-                bounding_boxes_path=None,
-                image_dims_large=self.image_dims_large,
-                image_dims_small=self.image_dims_small,
-            )
+        # Resumes a partial build, the source data is only checked for changes
+        # if check_sources is set
+        create_image_caption_tfrecords(
+            tfrecords_dir=os.path.join(self.directory, "records"),
+            image_source_dir=os.path.join(self.directory, "images"),
+            text_source_dir=os.path.join(self.directory, "text"),
+            bounding_boxes_path=None,
+            image_dims_large=self.image_dims_large,
+            image_dims_small=self.image_dims_small,
+            **self.build_options,
+        )
 
         records_dir = os.path.join(self.directory, "records")
         if os.path.isdir(records_dir):
@@ -153,38 +623,228 @@ class FlowersWithWordsDataset(StackGANDataset):
 class XRaysDataset(StackGANDataset):
     """ XXX: Container for the x-rays dataset properties """
 
-    def __init__(self):
-        super().__init__()
-        # TODO: Rename valid to test in data download
+    def __init__(self, **build_options):
+        super().__init__(**build_options)
         self.type = "images-with-tabular"
-        # NOTE: width and height are for the small dataset for now
-        self.image_dims_small = (None, None)
+        # NOTE: width and height are for the small dataset for now, the small
+        # images are half the size, which keeps their aspect ratio exact
+        self.image_dims_small = (195, 160)
         self.image_dims_large = (390, 320)
         self.num_channels = 1
-        # TODO: Set this
-        self.text_embedding_dim = None
 
         base_directory = "data/CheXpert-v1.0-small"
         if not os.path.isdir(os.path.join(base_directory, "raw")):
             check_for_xrays(directory="data/CheXpert-v1.0-small")
 
         self.directory = os.path.join(base_directory, "records")
-        if not os.path.isdir(self.directory):
-            create_image_tabular_tfrecords(
-                tfrecords_dir=self.directory,
-                image_source_dir=os.path.join(base_directory, "raw"),
-                text_source_dir=os.path.join(base_directory, "raw"),
-                image_dims=(self.height, self.width),
+        # Resumes a partial build, the source data is only checked for changes
+        # if check_sources is set
+        create_image_tabular_tfrecords(
+            tfrecords_dir=self.directory,
+            image_source_dir=os.path.join(base_directory, "raw"),
+            text_source_dir=os.path.join(base_directory, "raw"),
+            image_dims_large=self.image_dims_large,
+            image_dims_small=self.image_dims_small,
+            num_channels=self.num_channels,
+            **self.build_options,
+        )
+        # The valid split is stored as the test subset
+        self.text_embedding_dim = read_metadata(self.directory).get("num_text_features")
+
+
+class MemmapDataset(StackGANDataset):
+    """ Serves the examples of an images-with-captions dataset from memory-mapped
+        .npy arrays, which are converted once from its TFRecords. The images are
+        stored decoded, so reading a batch is a gather from the page cache which
+        can be shared by every training process on the host.
+    """
+
+    def __init__(self, source: StackGANDataset, **build_options):
+        super().__init__(**build_options)
+        if source.type != "images-with-captions":
+            raise Exception(
+                f"The npy backend only supports images-with-captions datasets, not {source.type}"
             )
+        self.source = source
+        self.type = source.type
+        self.image_dims_small = source.image_dims_small
+        self.image_dims_large = source.image_dims_large
+        self.num_channels = source.num_channels
+        self.text_embedding_dim = source.text_embedding_dim
+        self.directory = os.path.join(os.path.dirname(str(source.directory)), "npy")
+
+    def parse_dataset(
+        self,
+        subset: str = "train",
+        batch_size: int = 1,
+        features: Optional[Iterable[str]] = None,
+        input_context: Optional[tf.distribute.InputContext] = None,
+    ):
+        """ Gather shuffled batches from the memory-mapped arrays of a subset,
+            in the same form as the batches parsed from the TFRecords. If features
+            is given, only those features are gathered. If an input_context is
+            given, the examples are split between the workers anew every epoch.
+        """
+        arrays = self._load_memmaps(subset)
+        num_examples = len(arrays["labels"])
+        example_idxs = tf.data.Dataset.range(num_examples)
+        if input_context is not None and input_context.num_input_pipelines > 1:
+            # Every worker draws the same order, and takes its share of it
+            example_idxs = example_idxs.shuffle(
+                buffer_size=num_examples,
+                seed=self.shard_seed,
+                reshuffle_each_iteration=True,
+            ).shard(input_context.num_input_pipelines, input_context.input_pipeline_id)
+        else:
+            example_idxs = example_idxs.shuffle(buffer_size=num_examples)
+        batched_subset_obj = self._gather_batches(
+            arrays, example_idxs.batch(batch_size), features
+        )
+        if self.wrong_images == "batch":
+            batched_subset_obj = batched_subset_obj.map(
+                add_batch_wrong_images, num_parallel_calls=self.num_parallel_calls
+            )
+        return batched_subset_obj.prefetch(self.prefetch_batches)
+
+    def read_examples(
+        self,
+        subset: str,
+        shuffle_shards: bool = True,
+        features: Optional[Iterable[str]] = None,
+    ) -> tf.data.Dataset:
+        """ Read the (unbatched) examples of a subset from its memory-mapped arrays.
+            If shuffle_shards is False, the examples are read in the order in
+            which they were converted. If features is given, only those are read.
+        """
+        arrays = self._load_memmaps(subset)
+        num_examples = len(arrays["labels"])
+        example_idxs = tf.data.Dataset.range(num_examples)
+        if shuffle_shards:
+            example_idxs = example_idxs.shuffle(buffer_size=num_examples)
+        return self._gather_batches(
+            arrays, example_idxs.batch(MEMMAP_GATHER_SIZE), features
+        ).unbatch()
+
+    def num_examples(
+        self, subset: str, input_context: Optional[tf.distribute.InputContext] = None
+    ) -> int:
+        return self.source.num_examples(subset, input_context)
+
+    def _load_memmaps(self, subset: str) -> dict:
+        """ Open the arrays of a subset, converting them from the TFRecords first
+            if they are missing or older than the records.
+        """
+        if subset not in ["train", "test"]:
+            raise Exception(
+                "Invalid subset type: {}, expected train or test".format(subset)
+            )
+        memmap_dir = os.path.join(self.directory, subset)
+        metadata = read_metadata(self.directory)
+        fingerprint = self.source.records_fingerprint(subset)
+        if metadata.get("subsets", {}).get(subset, {}).get("fingerprint") != fingerprint:
+            self._convert_subset(subset, memmap_dir)
+            metadata = read_metadata(self.directory)
+            metadata.setdefault("subsets", {})[subset] = {"fingerprint": fingerprint}
+            metadata["wrong_images"] = self.source.wrong_images
+            write_metadata(self.directory, metadata)
+        self.wrong_images = metadata.get("wrong_images", "stored")
+
+        array_names = ["images_small", "images_large", "text", "labels", "names"]
+        if self.wrong_images == "stored":
+            array_names.append("wrong_index")
+        arrays = {
+            array_name: np.load(os.path.join(memmap_dir, f"{array_name}.npy"), mmap_mode="r")
+            for array_name in array_names
+        }
+        text_offsets = np.load(os.path.join(memmap_dir, "text_offsets.npy"))
+        if len(set(np.diff(text_offsets))) > 1:
+            raise Exception("Every example must have the same number of captions")
+        return arrays
+
+    def _gather_batches(
+        self,
+        arrays: dict,
+        batched_idxs: tf.data.Dataset,
+        features: Optional[Iterable[str]] = None,
+    ) -> tf.data.Dataset:
+        """ Gather the (selected) features of each batch of example indices from
+            the arrays, with the images converted to float32
+        """
+        num_examples = len(arrays["labels"])
+        # The array from which each feature is gathered
+        feature_arrays = {
+            "image_small": arrays["images_small"],
+            "image_large": arrays["images_large"],
+            "name": arrays["names"],
+            "text": arrays["text"].reshape(num_examples, -1),
+            "label": arrays["labels"],
+        }
+        if "wrong_index" in arrays:
+            feature_arrays["wrong_image_small"] = arrays["images_small"]
+            feature_arrays["wrong_image_large"] = arrays["images_large"]
+        selected_features = self.select_features(features)
+        feature_names = [name for name in feature_arrays if name in selected_features]
+        output_types = [
+            tf.string if feature_arrays[name].dtype.kind == "S" else feature_arrays[name].dtype
+            for name in feature_names
+        ]
+
+        def gather_batch(idxs):
+            # Reading in index order keeps the memory map accesses local
+            idxs = np.sort(idxs)
+            if "wrong_index" in arrays:
+                wrong_idxs = arrays["wrong_index"][idxs]
+            return [
+                feature_arrays[name][wrong_idxs if name.startswith("wrong_") else idxs]
+                for name in feature_names
+            ]
+
+        def to_features(idxs):
+            batch = tf.numpy_function(gather_batch, [idxs], output_types)
+            features = {}
+            for name, feature in zip(feature_names, batch):
+                feature.set_shape([None, *feature_arrays[name].shape[1:]])
+                features[name] = feature
+            return cast_images(features)
+
+        return batched_idxs.map(to_features, num_parallel_calls=self.num_parallel_calls)
+
+    def _convert_subset(self, subset: str, memmap_dir: str):
+        """ Write the examples of a subset, in record order, to the arrays """
+        print(f"Converting the {subset} TFRecords to memory-mapped arrays in {memmap_dir}")
+        example_iterable = (
+            {name: value.numpy() for name, value in example.items()}
+            for example in self.source.read_examples(subset, shuffle_shards=False)
+        )
+        write_image_caption_memmaps(
+            example_iterable,
+            num_examples=self.source.num_examples(subset),
+            memmap_dir=memmap_dir,
+            image_shapes=self.source.image_shapes
+            or {
+                "image_small": [*self.get_small_dims()[1:], self.num_channels],
+                "image_large": [*self.get_large_dims()[1:], self.num_channels],
+            },
+            text_embedding_dim=self.text_embedding_dim,
+            wrong_index_seed=self.shard_seed if self.source.wrong_images == "stored" else None,
+        )
 
 
-def get_dataset(dataset_name: str) -> StackGANDataset:
+def get_dataset(
+    dataset_name: str, backend: str = "tfrecord", **build_options
+) -> StackGANDataset:
     """ Get the dataset object which contains information
-        about the properties of the dataset
+        about the properties of the dataset. The 'npy' backend serves
+        the examples from memory-mapped arrays instead of the TFRecords.
     """
+    if backend not in BACKENDS:
+        raise Exception(f"Invalid dataset backend {backend}, expected one of {BACKENDS}")
     if dataset_name in DATASETS:
         dataset = DATASETS_DICT[dataset_name]
         print(dataset)
-        return eval(dataset)()
+        dataset_object = eval(dataset)(**build_options)
+        if backend == "npy":
+            return MemmapDataset(dataset_object, **build_options)
+        return dataset_object
     else:
         raise Exception("Invalid dataset name {}.".format(dataset_name))
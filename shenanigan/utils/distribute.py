@@ -0,0 +1,90 @@
+import json
+import os
+
+import tensorflow as tf
+from typing import Dict
+
+STRATEGIES = ["none", "mirrored", "multi_worker"]
+
+
+def get_strategy(strategy: str = "none", num_logical_cpus: int = 0):
+    """ Create the tf.distribute strategy used to train the models. Must be
+        called before any other TensorFlow operation runs, as both the logical
+        devices and the multi-worker cluster are fixed once the runtime starts.
+        Arguments:
+            strategy: str
+                none: train on the default device.
+                mirrored: synchronous training over all local GPUs, or over
+                    num_logical_cpus logical CPU devices if it is given.
+                multi_worker: synchronous training over the workers listed in
+                    the TF_CONFIG environment variable.
+            num_logical_cpus: int
+                Split the CPU into this many logical devices and mirror over them.
+                Useful to exercise the distributed code paths on a CPU-only host.
+    """
+    if strategy not in STRATEGIES:
+        raise Exception(
+            "Unexpected strategy: {}. Expected one of {}".format(strategy, STRATEGIES)
+        )
+    if num_logical_cpus:
+        cpu = tf.config.list_physical_devices("CPU")[0]
+        tf.config.set_logical_device_configuration(
+            cpu, [tf.config.LogicalDeviceConfiguration()] * num_logical_cpus
+        )
+
+    if strategy == "none":
+        return tf.distribute.get_strategy()
+    elif strategy == "mirrored":
+        devices = None
+        if num_logical_cpus:
+            devices = [
+                device.name
+                for device in tf.config.list_logical_devices("CPU")
+            ]
+        return tf.distribute.MirroredStrategy(devices)
+    return tf.distribute.MultiWorkerMirroredStrategy()
+
+
+def worker_index() -> int:
+    """ The index of this worker in the TF_CONFIG cluster, 0 if there is none """
+    task = json.loads(os.environ.get("TF_CONFIG", "{}")).get("task", {})
+    return int(task.get("index", 0))
+
+
+def task_name() -> str:
+    """ The type and index of this task in the TF_CONFIG cluster, e.g. worker-1,
+        worker-0 if there is none
+    """
+    task = json.loads(os.environ.get("TF_CONFIG", "{}")).get("task", {})
+    return f"{task.get('type', 'worker')}-{worker_index()}"
+
+
+def is_chief() -> bool:
+    """ Whether this worker is the one responsible for logging and checkpoints.
+        That is the chief task if the cluster has one, otherwise worker 0.
+    """
+    tf_config = json.loads(os.environ.get("TF_CONFIG", "{}"))
+    task = tf_config.get("task", {})
+    if "chief" in tf_config.get("cluster", {}):
+        return task.get("type") == "chief"
+    return task.get("type", "worker") == "worker" and worker_index() == 0
+
+
+def peak_memory() -> Dict[str, int]:
+    """ The peak memory, in bytes, TensorFlow has allocated on each GPU so far.
+        Empty without GPUs, since the CPU allocator does not track it, and
+        if this version of TensorFlow cannot report it.
+    """
+    get_memory_info = getattr(tf.config.experimental, "get_memory_info", None)
+    if get_memory_info is None:
+        return {}
+    peaks = {}
+    for device in tf.config.list_logical_devices("GPU"):
+        try:
+            memory_info = get_memory_info(device.name)
+        except ValueError:
+            # Raised for devices whose allocator does not collect statistics
+            continue
+        if "peak" in memory_info:
+            peaks[device.name] = memory_info["peak"]
+    return peaks
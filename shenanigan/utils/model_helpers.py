@@ -1,9 +1,23 @@
+import atexit
+import os
+import time
 import tensorflow as tf
 from shenanigan.utils import rmdir
 
 
 class Checkpointer(object):
-    def __init__(self, model: tf.keras.Model, save_dir: str, max_keep: int = None):
+    def __init__(
+        self,
+        model: tf.keras.Model,
+        save_dir: str,
+        max_keep: int = None,
+        async_write: bool = False,
+    ):
+        """ Save and restore the model and its optimizers.
+            With async_write, save only copies the variables to the host, and
+            the checkpoint files are written on a background thread. A save waits
+            for the previous write, so at most one is pending at a time.
+        """
         self.ckpt = tf.train.Checkpoint(
             step=tf.Variable(0),
             discriminator=model.discriminator,
@@ -13,9 +27,25 @@ class Checkpointer(object):
             loss=tf.Variable(1e06),  # some large number
         )
         self.checkpoint_dir = save_dir
+        self.max_keep = max_keep
         self.ckpt_manager = tf.train.CheckpointManager(
             self.ckpt, self.checkpoint_dir, max_to_keep=max_keep
         )
+        self.async_write = async_write
+        # (epoch, path) of the last checkpoint saved. The manager only lists
+        # checkpoints written asynchronously once they have been written
+        self._last_save = None
+        # (source, source checkpoint, checkpoint) whose files are still to be linked
+        self._pending_link = None
+        # The Checkpointers which link to this one's checkpoints
+        self._linked_checkpointers = []
+        if async_write:
+            # TensorFlow writes a pending checkpoint before the interpreter exits
+            self.options = tf.train.CheckpointOptions(
+                experimental_enable_async_checkpoint=True
+            )
+        # Registered before TensorFlow's exit handler, so it runs after it
+        atexit.register(self.complete_link, wait=False)
 
     def restore(self, use_pretrained: bool = False, evaluate: bool = False):
         if use_pretrained:
@@ -33,7 +63,105 @@ class Checkpointer(object):
             print("Initializing model from scratch")
 
     def save(self):
-        return self.ckpt_manager.save(checkpoint_number=self.get_epoch_num())
+        self.complete_link()
+        # This save may delete a checkpoint another Checkpointer still has to link
+        for checkpointer in self._linked_checkpointers:
+            checkpointer.complete_link()
+        if not self.async_write:
+            save_path = self.ckpt_manager.save(checkpoint_number=self.get_epoch_num())
+        else:
+            save_path = self.ckpt_manager.save(
+                checkpoint_number=self.get_epoch_num(), options=self.options
+            )
+        self._last_save = (self.get_epoch_num(), save_path)
+        return save_path
+
+    def link(self, source: "Checkpointer"):
+        """ Save the checkpoint source saved in the same epoch, by hard linking its
+            files instead of writing the same variables again. The files are
+            deleted once neither Checkpointer keeps them, as every link counts
+            as a reference. They are copied if they cannot be linked.
+            While source's write is pending, the files are only linked once it
+            has finished, see complete_link, so link does not wait for it.
+            Returns the path of the checkpoint.
+        """
+        self.complete_link()
+        if source._last_save is None or source._last_save[0] != self.get_epoch_num():
+            return self.save()
+        source_path = source._last_save[1]
+        save_path = os.path.join(self.checkpoint_dir, f"ckpt-{self.get_epoch_num()}")
+        if self not in source._linked_checkpointers:
+            source._linked_checkpointers.append(self)
+        self._pending_link = (source, source_path, save_path)
+        if not source.async_write:
+            self.complete_link()
+        return save_path
+
+    def complete_link(self, wait: bool = True):
+        """ Link the files of the checkpoint passed to link, once its write has
+            finished. Called before this Checkpointer saves, links or flushes,
+            before the source saves again (which may delete the checkpoint), and
+            at exit. With wait False the writes must have finished already.
+        """
+        if self._pending_link is None:
+            return
+        source, source_path, save_path = self._pending_link
+        self._pending_link = None
+        if wait:
+            source.flush()
+            self.flush()
+
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        for source_file in tf.io.gfile.glob(f"{source_path}.*"):
+            target_file = save_path + source_file[len(source_path) :]
+            if os.path.exists(target_file) and os.path.samefile(source_file, target_file):
+                continue
+            try:
+                os.link(source_file, target_file)
+            except OSError:
+                # E.g. another file system, or the checkpoint exists already
+                tf.io.gfile.copy(source_file, target_file, overwrite=True)
+
+        # The manager only keeps the checkpoints saved after last_preserved_timestamp
+        state = tf.train.get_checkpoint_state(self.checkpoint_dir)
+        if state is not None:
+            timestamps = dict(
+                zip(state.all_model_checkpoint_paths, state.all_model_checkpoint_timestamps)
+            )
+            last_preserved_timestamp = state.last_preserved_timestamp
+        else:
+            timestamps = {}
+            last_preserved_timestamp = time.time() - 1.0
+        timestamps[save_path] = time.time()
+
+        checkpoints = [path for path in self.ckpt_manager.checkpoints if path != save_path]
+        checkpoints.append(save_path)
+        if self.max_keep is not None:
+            for old_path in checkpoints[: -self.max_keep]:
+                for old_file in tf.io.gfile.glob(f"{old_path}.*"):
+                    tf.io.gfile.remove(old_file)
+            checkpoints = checkpoints[-self.max_keep :]
+        tf.compat.v1.train.update_checkpoint_state(
+            self.checkpoint_dir,
+            save_path,
+            all_model_checkpoint_paths=checkpoints,
+            all_model_checkpoint_timestamps=[
+                timestamps.get(path, time.time()) for path in checkpoints
+            ],
+            last_preserved_timestamp=last_preserved_timestamp,
+        )
+        # The manager reads the checkpoints it keeps from the state file
+        self.ckpt_manager = tf.train.CheckpointManager(
+            self.ckpt, self.checkpoint_dir, max_to_keep=self.max_keep
+        )
+
+    def flush(self):
+        """ Wait until the checkpoints saved or linked so far are written.
+            Synchronous saves have been written when save returns.
+        """
+        if self.async_write:
+            self.ckpt.sync()
+        self.complete_link()
 
     def get_epoch_num(self):
         return int(self.ckpt.step)
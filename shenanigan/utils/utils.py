@@ -1,4 +1,5 @@
 from glob import glob
+import hashlib
 import json
 import os
 import pickle
@@ -69,6 +70,9 @@ def sample_normal(mean: tf.Tensor, log_var: tf.Tensor) -> tf.Tensor:
 
 
 def kl_loss(mean: tf.Tensor, log_sigma: tf.Tensor):
+    # In float32, also when the generator computes in float16 or bfloat16
+    mean = tf.cast(mean, tf.float32)
+    log_sigma = tf.cast(log_sigma, tf.float32)
     loss = -log_sigma + 0.5 * (-1 + tf.math.exp(2.0 * log_sigma) + tf.math.square(mean))
     loss = tf.reduce_mean(loss)
     return loss
@@ -92,6 +96,15 @@ def mkdir(directory: str):
         pass
 
 
+def file_sha256(file_name: str, block_size: int = 1 << 20) -> str:
+    """ Compute the SHA-256 hex digest of a file, reading it in blocks """
+    file_hash = hashlib.sha256()
+    with open(file_name, "rb") as fd:
+        for block in iter(lambda: fd.read(block_size), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
 def remove_file(file_name: str):
     try:
         os.remove(file_name)
@@ -125,16 +138,6 @@ def format_for_windows(path_string: str) -> str:
     return str(str(path_string).replace("/", "\\"))
 
 
-def num_tfrecords_in_dir(directory: str) -> int:
-    return len(
-        [
-            name
-            for name in os.listdir(directory)
-            if os.path.isfile(name) and name.endswith(".tfrecord")
-        ]
-    )
-
-
 def normalise(num_list: List[Union[int, float]]) -> List[Union[int, float]]:
     """ Simple normalisation into [0,1] """
     max_x = max(num_list)
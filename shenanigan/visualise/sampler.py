@@ -1,7 +1,4 @@
-from shenanigan.utils.data_helpers import extract_image_with_text
-
 from random import randint
-import numpy as np
 import tensorflow as tf
 from typing import Callable, Tuple
 
@@ -33,17 +30,13 @@ def sample_small_img_with_captions(
     """ A function which samples from the images-with-captions dataset.
         We return the image and caption (embedding) as a tuple
     """
-    sample = next(iter(data_loader.parsed_subset))
-    sample_batch_size = len(sample["text"].numpy())
-    random_idx = randint(0, sample_batch_size - 1)
-    image, _, text = extract_image_with_text(
-        sample=sample,
-        index=random_idx,
-        embedding_size=1024,
-        num_embeddings_to_sample=NUM_EMBEDDINGS_TO_SAMPLE,
-        img_size=img_size,
+    # Prepared as for training: flipped, cropped and normalised
+    image, _, text = next(
+        iter(
+            data_loader.prepared(
+                NUM_EMBEDDINGS_TO_SAMPLE, augment=True, img_size=img_size
+            )
+        )
     )
-
-    if len(text.shape) == 1:
-        txt = text[np.newaxis, :]
-    return (image, txt)
+    random_idx = randint(0, image.shape[0] - 1)
+    return (image[random_idx], text[random_idx : random_idx + 1])
@@ -8,7 +8,6 @@ from PIL import Image
 from shenanigan.utils.utils import mkdir, rmdir
 from shenanigan.visualise.sampler import sample_data
 from shenanigan.visualise.utils import concate_horizontallly
-from shenanigan.utils.data_helpers import transform_image
 
 
 def compare_generated_to_real(
@@ -37,15 +36,15 @@ def compare_generated_to_real(
         for embedding, noise in zip(real_embeddings, noise_list)
     ]
 
-    real_images = format_as_images(real_tensors, is_real=True)
-    stage1_images = format_as_images(stage1_tensors, is_real=False)
+    real_images = format_as_images(real_tensors)
+    stage1_images = format_as_images(stage1_tensors)
 
     if subsequent_model is not None:
         stage2_tensors = [
             subsequent_model.generator([generated_image, embedding], training=False)[0]
             for generated_image, embedding in zip(stage1_tensors, real_embeddings)
         ]
-        stage2_images = format_as_images(stage2_tensors, is_real=False)
+        stage2_images = format_as_images(stage2_tensors)
         for i, (real_image, stage1_image, stage2_image) in enumerate(
             zip(real_images, stage1_images, stage2_images)
         ):
@@ -59,11 +58,9 @@ def compare_generated_to_real(
             image.save(os.path.join(save_location, f"fake-vs-real-{i}.png"))
 
 
-def format_as_images(tensors, is_real):
+def format_as_images(tensors):
     image_list = []
     for tensor in tensors:
-        if is_real:
-            tensor = transform_image(tensor)
         if len(tensor.shape) == 4:
             tensor = tf.squeeze(tensor, axis=0)
         image = (tensor.numpy() + 1) * 255.0 / 2
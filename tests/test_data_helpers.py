@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from shenanigan.utils.data_helpers import batch_label_derangement
+
+
+@pytest.mark.parametrize(
+    "labels, max_same_label_pairs",
+    [
+        ([2, 0, 1, 0, 2, 1], 0),  # balanced
+        ([1, 0, 0, 1, 0, 0], 2),  # majority label, 4 of 6
+        ([3, 3, 3, 3], 4),  # single label
+    ],
+)
+def test_batch_label_derangement(labels, max_same_label_pairs):
+    labels = np.array(labels)
+    partner_idxs = batch_label_derangement(tf.constant(labels)).numpy()
+
+    # A permutation of the batch which never pairs a sample with itself
+    assert sorted(partner_idxs) == list(range(len(labels)))
+    assert np.all(partner_idxs != np.arange(len(labels)))
+    # Samples only share a partner's label where a label fills over half the batch
+    assert np.sum(labels[partner_idxs] == labels) <= max_same_label_pairs
@@ -0,0 +1,215 @@
+import multiprocessing
+import os
+import numpy as np
+import pytest
+import tensorflow as tf
+from PIL import Image
+from typing import List
+
+from shenanigan.dataloaders.dataloaders import ImageTextDataLoader
+from shenanigan.utils.data_helpers import (
+    image_to_bytes,
+    write_metadata,
+    write_records_to_file,
+)
+from shenanigan.utils.datasets import StackGANDataset
+
+NUM_EXAMPLES = 40
+EXAMPLES_PER_SHARD = 4
+NUM_WORKERS = 2
+BATCH_SIZE = 3
+NUM_EPOCHS = 3
+
+
+class SyntheticDataset(StackGANDataset):
+    """ A small image-caption dataset, read from TFRecords in directory """
+
+    def __init__(self, directory: str, **build_options):
+        super().__init__(**build_options)
+        self.type = "images-with-captions"
+        self.image_dims_small = (4, 4)
+        self.image_dims_large = (8, 8)
+        self.num_channels = 3
+        self.text_embedding_dim = 2
+        self.directory = directory
+
+
+def write_synthetic_records(records_dir: str):
+    """ Write NUM_EXAMPLES examples, named by their index, to shards of
+        EXAMPLES_PER_SHARD examples. The pixels of an example's images are its index.
+    """
+    text = np.zeros((1, 2), dtype=np.float32).tobytes()
+    example_iterable = (
+        (
+            str(idx).encode("utf-8"),
+            image_to_bytes(Image.new("RGB", (4, 4), (idx, idx, idx))),
+            image_to_bytes(Image.new("RGB", (8, 8), (idx, idx, idx))),
+            None,
+            None,
+            text,
+            idx % 3,
+        )
+        for idx in range(NUM_EXAMPLES)
+    )
+    shards = write_records_to_file(
+        example_iterable, "train", records_dir, examples_per_shard=EXAMPLES_PER_SHARD
+    )
+    write_metadata(
+        records_dir,
+        {
+            "wrong_images": "batch",
+            "image_encoding": "png",
+            "image_shapes": {"image_small": [4, 4, 3], "image_large": [8, 8, 3]},
+            "subsets": {
+                "train": {
+                    "complete": True,
+                    "num_examples": NUM_EXAMPLES,
+                    "windows": [{"fingerprint": None, "shards": shards}],
+                }
+            },
+        },
+    )
+
+
+def read_worker_epochs(records_dir: str, cache: str, worker_id: int) -> List[List[str]]:
+    """ The names of the examples read by one worker in each epoch """
+    input_context = tf.distribute.InputContext(
+        num_input_pipelines=NUM_WORKERS,
+        input_pipeline_id=worker_id,
+        num_replicas_in_sync=NUM_WORKERS,
+    )
+    loader = ImageTextDataLoader(
+        SyntheticDataset(records_dir, cache=cache),
+        batch_size=BATCH_SIZE,
+        subset="train",
+        features=["image_small", "name", "label"],
+        input_context=input_context,
+    )
+    return [
+        [name.decode("utf-8") for batch in loader() for name in batch["name"].numpy()]
+        for _ in range(NUM_EPOCHS)
+    ]
+
+
+@pytest.mark.parametrize("cache", ["none", "memory", "disk"])
+def test_workers_read_every_example_once_per_epoch(tmp_path, cache):
+    records_dir = os.path.join(str(tmp_path), "records")
+    write_synthetic_records(records_dir)
+
+    # Every worker runs in its own process, as it would on its own host
+    with multiprocessing.get_context("spawn").Pool(NUM_WORKERS) as pool:
+        worker_epochs = pool.starmap(
+            read_worker_epochs,
+            [(records_dir, cache, worker_id) for worker_id in range(NUM_WORKERS)],
+        )
+
+    expected_names = sorted(str(idx) for idx in range(NUM_EXAMPLES))
+    for epoch in range(NUM_EPOCHS):
+        epoch_names = [name for epochs in worker_epochs for name in epochs[epoch]]
+        assert sorted(epoch_names) == expected_names
+
+
+@pytest.mark.parametrize("cache", ["memory", "disk"])
+def test_cached_examples_are_reshuffled_every_epoch(tmp_path, cache):
+    records_dir = os.path.join(str(tmp_path), "records")
+    write_synthetic_records(records_dir)
+    loader = ImageTextDataLoader(
+        SyntheticDataset(records_dir, cache=cache),
+        batch_size=BATCH_SIZE,
+        subset="train",
+        features=["image_small", "name", "label"],
+    )
+
+    epochs = [
+        [name.decode("utf-8") for batch in loader() for name in batch["name"].numpy()]
+        for _ in range(NUM_EPOCHS)
+    ]
+    expected_names = sorted(str(idx) for idx in range(NUM_EXAMPLES))
+    for names in epochs:
+        assert sorted(names) == expected_names
+    assert len({tuple(names) for names in epochs}) == NUM_EPOCHS
+
+
+def test_workers_write_their_own_disk_caches(tmp_path):
+    records_dir = os.path.join(str(tmp_path), "records")
+    write_synthetic_records(records_dir)
+
+    with multiprocessing.get_context("spawn").Pool(NUM_WORKERS) as pool:
+        pool.starmap(
+            read_worker_epochs,
+            [(records_dir, "disk", worker_id) for worker_id in range(NUM_WORKERS)],
+        )
+
+    cache_dir = os.path.join(str(tmp_path), "cache")
+    pipeline_dirs = sorted(os.listdir(cache_dir))
+    assert pipeline_dirs == [
+        f"worker-0-pipeline-{worker_id}-of-{NUM_WORKERS}" for worker_id in range(NUM_WORKERS)
+    ]
+    # Each pipeline caches its own half of the shards
+    cached_shards = [
+        {name.split(".tfrecord")[0][-5:] for name in os.listdir(os.path.join(cache_dir, d))}
+        for d in pipeline_dirs
+    ]
+    assert not cached_shards[0] & cached_shards[1]
+    assert len(cached_shards[0] | cached_shards[1]) == NUM_EXAMPLES // EXAMPLES_PER_SHARD
+
+
+def read_replica_epochs(
+    records_dir: str, global_batch_size: int, drop_remainder: bool
+) -> List[List[List[int]]]:
+    """ The examples, by index, in every replica's batches of each epoch, read
+        through ImageTextDataLoader.distributed with a MirroredStrategy over
+        NUM_WORKERS logical CPUs
+    """
+    cpu = tf.config.list_physical_devices("CPU")[0]
+    tf.config.set_logical_device_configuration(
+        cpu, [tf.config.LogicalDeviceConfiguration()] * NUM_WORKERS
+    )
+    strategy = tf.distribute.MirroredStrategy(
+        [f"/cpu:{idx}" for idx in range(NUM_WORKERS)]
+    )
+    loader = ImageTextDataLoader(
+        SyntheticDataset(records_dir),
+        batch_size=global_batch_size,
+        subset="train",
+        features=["image_small", "text", "label"],
+    )
+    batches = iter(loader.distributed(strategy, 1, False, "small", drop_remainder))
+    epochs = []
+    for _ in range(NUM_EPOCHS):
+        epoch = []
+        for _ in range(loader.num_batches(drop_remainder)):
+            image, _, text = next(batches)
+            for replica_image, replica_text in zip(
+                strategy.experimental_local_results(image),
+                strategy.experimental_local_results(text),
+            ):
+                assert replica_image.shape[1:] == (4, 4, 3)
+                assert replica_text.shape[0] == replica_image.shape[0]
+                epoch.append([int(x) for x in replica_image[:, 0, 0, 0].numpy()])
+        epochs.append(epoch)
+    return epochs
+
+
+@pytest.mark.parametrize(
+    "global_batch_size, drop_remainder", [(4, False), (6, False), (6, True)]
+)
+def test_replicas_read_every_example_once_per_epoch(tmp_path, global_batch_size, drop_remainder):
+    records_dir = os.path.join(str(tmp_path), "records")
+    write_synthetic_records(records_dir)
+
+    # The logical CPUs have to be set up before TensorFlow initialises its devices
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        epochs = pool.apply(read_replica_epochs, (records_dir, global_batch_size, drop_remainder))
+
+    per_replica_batch_size = global_batch_size // NUM_WORKERS
+    num_full_batches = NUM_EXAMPLES // global_batch_size * NUM_WORKERS
+    for epoch in epochs:
+        # Only the last batches of an epoch are partial, unless they are dropped
+        assert all(len(batch) == per_replica_batch_size for batch in epoch[:num_full_batches])
+        idxs = [idx for batch in epoch for idx in batch]
+        assert len(idxs) == len(set(idxs))
+        if drop_remainder:
+            assert len(epoch) == num_full_batches
+        else:
+            assert sorted(idxs) == list(range(NUM_EXAMPLES))